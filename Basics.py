@@ -1,7 +1,22 @@
-import pygame
+import os
 import sys
 import random # For AI tie-breaking
 import math # For infinity
+import time # Search time budget
+import threading # Background AI search
+from array import array # Fixed-size transposition table storage
+import mmap # Opening book lookups straight from the file
+import struct # Opening book record packing
+import re # SAN parsing for the opening book builder
+import itertools # Streaming PGN reading
+pygame = None # Bound by _pygame() on first use, so headless and UCI use never load pygame or SDL
+
+def _pygame():
+    # Imports pygame for the game window and drawing code; raises ImportError without it
+    global pygame
+    if pygame is None:
+        import pygame
+    return pygame
 
 WIDTH, HEIGHT = 640, 640
 ROWS, COLS = 8, 8
@@ -26,14 +41,724 @@ PLAYER_WHITE_IS_AI = True
 PLAYER_BLACK_IS_AI = True
 
 # --- AI Configuration ---
-AI_DEPTH = 2  # Search depth for Minimax. Higher is stronger but much slower.
-AI_THINKING_DURATION = 5000 # Milliseconds (5 seconds)
+AI_DEPTH = 2  # Fixed search depth for get_ai_move. Higher is stronger but much slower.
+AI_THINKING_DURATION = 5000 # Milliseconds (5 seconds) of search time per AI move
+TT_SIZE_MB = 16 # Memory budget for the transposition table
+MAX_SEARCH_DEPTH = 64 # Depth cap for the time-managed search
+ASPIRATION_WINDOW = 15 # Half-width of the aspiration window around the previous iteration's score
+ID_NEXT_ITERATION_FRACTION = 0.5 # Don't start a new depth once this much of the budget is used
+AI_PONDER = True # Search on the human's time when only one side is AI
+AI_WORKERS = os.cpu_count() or 1 # Worker processes for parallel_get_ai_move
+MAX_PLY = 128 # Size of the per-ply killer move table
+QUIESCENCE_DEPTH = 8 # Capture plies searched past the horizon; 0 scores the horizon statically
+SEARCH_STATS_LOG = None # Path of a JSON-lines file get_ai_move_with_stats appends one record per search to
+USE_OPENING_BOOK = True # Play book moves while the position is in the book file below
+OPENING_BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opening_book.bin")
+USE_TABLEBASES = True # Probe endgame tablebases (if any have been built) in the search
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases")
+TABLEBASE_MAX_PIECES = 4 # Kings included
 
 PIECE_VALUES = {
     "p": 10, "n": 30, "b": 30, "r": 50, "q": 90, "k": 900, 
     ".": 0
 }
 
+# --- Position Representation ---
+# The search works on a compact 0x88 mailbox instead of the list-of-lists board.
+# Square index is (row << 4) | col, so row 0 is still Black's back rank and any
+# index with a bit of 0x88 set is off the board.
+EMPTY = 0
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = 1, 2, 3, 4, 5, 6
+BLACK_BIT = 8 # Piece code = piece type, plus BLACK_BIT for Black pieces
+
+PIECE_CODES = {
+    ".": EMPTY,
+    "P": PAWN, "N": KNIGHT, "B": BISHOP, "R": ROOK, "Q": QUEEN, "K": KING,
+    "p": PAWN | BLACK_BIT, "n": KNIGHT | BLACK_BIT, "b": BISHOP | BLACK_BIT,
+    "r": ROOK | BLACK_BIT, "q": QUEEN | BLACK_BIT, "k": KING | BLACK_BIT
+}
+CODE_TO_PIECE = ["."] * 16
+for _piece_char, _piece_code in PIECE_CODES.items():
+    CODE_TO_PIECE[_piece_code] = _piece_char
+
+BOARD_SQUARES = [(r << 4) | c for r in range(ROWS) for c in range(COLS)] # Scan order matches the list board
+
+KNIGHT_OFFSETS = [-33, -31, -18, -14, 14, 18, 31, 33] # Same order as (dr, dc) in get_valid_moves
+KING_OFFSETS = [-17, -16, -15, -1, 1, 15, 16, 17]
+ROOK_DIRECTIONS = [-16, 16, -1, 1]
+BISHOP_DIRECTIONS = [-17, -15, 15, 17]
+QUEEN_DIRECTIONS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+SLIDER_DIRECTIONS = {BISHOP: BISHOP_DIRECTIONS, ROOK: ROOK_DIRECTIONS, QUEEN: QUEEN_DIRECTIONS}
+
+# --- Attack Tables ---
+# Per-square jump and ray tables, indexed by 0x88 square, so attack queries can
+# look outward from the target square instead of generating enemy moves.
+def _build_jump_table(offsets):
+    table = [()] * 128
+    for sq in BOARD_SQUARES:
+        table[sq] = tuple(sq + offset for offset in offsets if not (sq + offset) & 0x88)
+    return table
+
+def _build_ray_table(directions):
+    table = [()] * 128
+    for sq in BOARD_SQUARES:
+        rays = []
+        for direction in directions:
+            ray = []
+            to_sq = sq + direction
+            while not to_sq & 0x88:
+                ray.append(to_sq)
+                to_sq += direction
+            if ray:
+                rays.append(tuple(ray))
+        table[sq] = tuple(rays)
+    return table
+
+KNIGHT_JUMPS = _build_jump_table(KNIGHT_OFFSETS)
+KING_JUMPS = _build_jump_table(KING_OFFSETS)
+# Squares a pawn of the given colour would attack this square from (index 0 = White, 1 = Black)
+PAWN_ATTACKER_SQUARES = [_build_jump_table([15, 17]), _build_jump_table([-15, -17])]
+ROOK_RAYS = _build_ray_table(ROOK_DIRECTIONS)
+BISHOP_RAYS = _build_ray_table(BISHOP_DIRECTIONS)
+
+def square_attacked(squares, sq, by_white):
+    # Reverse-ray attack query on a 0x88 square array
+    colour = 0 if by_white else BLACK_BIT
+    knight = KNIGHT | colour
+    for from_sq in KNIGHT_JUMPS[sq]:
+        if squares[from_sq] == knight:
+            return True
+    pawn = PAWN | colour
+    for from_sq in PAWN_ATTACKER_SQUARES[colour >> 3][sq]:
+        if squares[from_sq] == pawn:
+            return True
+    king = KING | colour
+    for from_sq in KING_JUMPS[sq]:
+        if squares[from_sq] == king:
+            return True
+    queen = QUEEN | colour
+    rook = ROOK | colour
+    for ray in ROOK_RAYS[sq]:
+        for from_sq in ray:
+            piece = squares[from_sq]
+            if piece != EMPTY:
+                if piece == rook or piece == queen:
+                    return True
+                break
+    bishop = BISHOP | colour
+    for ray in BISHOP_RAYS[sq]:
+        for from_sq in ray:
+            piece = squares[from_sq]
+            if piece != EMPTY:
+                if piece == bishop or piece == queen:
+                    return True
+                break
+    return False
+
+# --- Zobrist Hashing ---
+# One 64-bit key per (piece code, square) plus one for Black to move. A fixed
+# seed keeps keys identical between runs and processes.
+_zobrist_rng = random.Random(0x5EED_C4E55)
+ZOBRIST_PIECE_SQUARE = [[_zobrist_rng.getrandbits(64) if code & 7 else 0 for _ in range(128)]
+                        for code in range(16)]
+ZOBRIST_BLACK_TO_MOVE = _zobrist_rng.getrandbits(64)
+
+# Moves are packed ints: from | to << 7 | promotion type << 14 (0 means auto-queen)
+def encode_move(from_sq, to_sq, promotion_type=0):
+    return from_sq | (to_sq << 7) | (promotion_type << 14)
+
+def move_to_coords(move):
+    # Converts a packed move into the ((row, col), (row, col)) form used by the GUI
+    from_sq = move & 127
+    to_sq = (move >> 7) & 127
+    return ((from_sq >> 4, from_sq & 7), (to_sq >> 4, to_sq & 7))
+
+def coords_to_move(start_pos, end_pos, promotion_type=0):
+    return encode_move((start_pos[0] << 4) | start_pos[1], (end_pos[0] << 4) | end_pos[1], promotion_type)
+
+def as_position(board, white_to_move):
+    # Adapter for the public list-board API: reuses a Position when the side to move matches
+    if isinstance(board, Position):
+        if board.white_to_move == white_to_move:
+            return board
+        return Position(board.squares, white_to_move)
+    return Position.from_board(board, white_to_move)
+
+class Position:
+    # Mutable board with in-place make_move/unmake_move, so search never copies.
+    # Also keeps running midgame/endgame scores and phase for evaluate().
+    __slots__ = ("squares", "white_to_move", "king_squares", "hash", "mg_score", "eg_score", "phase", "piece_count")
+
+    def __init__(self, squares=None, white_to_move=True):
+        self.squares = bytearray(128) if squares is None else bytearray(squares)
+        self.white_to_move = white_to_move
+        self.king_squares = [-1, -1] # Indexed by colour: 0 = White, 1 = Black
+        self.hash = 0 if white_to_move else ZOBRIST_BLACK_TO_MOVE
+        self.mg_score = self.eg_score = self.phase = self.piece_count = 0
+        for sq in BOARD_SQUARES:
+            piece = self.squares[sq]
+            if piece != EMPTY:
+                self.piece_count += 1
+                self.hash ^= ZOBRIST_PIECE_SQUARE[piece][sq]
+                self.mg_score += EVAL_MG[piece][sq]
+                self.eg_score += EVAL_EG[piece][sq]
+                self.phase += PHASE_OF_CODE[piece]
+            if piece & 7 == KING:
+                self.king_squares[piece >> 3] = sq
+
+    @classmethod
+    def from_board(cls, board, white_to_move=True):
+        squares = bytearray(128)
+        for r_idx in range(ROWS):
+            for c_idx in range(COLS):
+                squares[(r_idx << 4) | c_idx] = PIECE_CODES[board[r_idx][c_idx]]
+        return cls(squares, white_to_move)
+
+    def to_board(self):
+        squares = self.squares
+        return [[CODE_TO_PIECE[squares[(r_idx << 4) | c_idx]] for c_idx in range(COLS)]
+                for r_idx in range(ROWS)]
+
+    @classmethod
+    def from_fen(cls, fen):
+        # Reads piece placement and side to move; castling/en passant fields are
+        # ignored because the game has neither
+        fields = fen.split()
+        squares = bytearray(128)
+        for r_idx, rank_text in enumerate(fields[0].split("/")):
+            c_idx = 0
+            for char in rank_text:
+                if char.isdigit():
+                    c_idx += int(char)
+                else:
+                    squares[(r_idx << 4) | c_idx] = PIECE_CODES[char]
+                    c_idx += 1
+        return cls(squares, len(fields) < 2 or fields[1] == "w")
+
+    def to_fen(self):
+        ranks = []
+        for r_idx in range(ROWS):
+            rank_text, empty_run = "", 0
+            for c_idx in range(COLS):
+                piece = self.squares[(r_idx << 4) | c_idx]
+                if piece == EMPTY:
+                    empty_run += 1
+                    continue
+                if empty_run:
+                    rank_text += str(empty_run)
+                    empty_run = 0
+                rank_text += CODE_TO_PIECE[piece]
+            ranks.append(rank_text + (str(empty_run) if empty_run else ""))
+        return "/".join(ranks) + (" w" if self.white_to_move else " b") + " - - 0 1"
+
+    def copy(self):
+        return Position(self.squares, self.white_to_move)
+
+    def turn_str(self):
+        return "White" if self.white_to_move else "Black"
+
+    def make_move(self, move):
+        # Plays move in place and returns the undo record for unmake_move
+        squares = self.squares
+        from_sq = move & 127
+        to_sq = (move >> 7) & 127
+        piece = squares[from_sq]
+        captured = squares[to_sq]
+        prev_hash = self.hash
+        squares[from_sq] = EMPTY
+        if piece & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1):
+            placed = (piece & BLACK_BIT) | ((move >> 14) or QUEEN)
+        else:
+            placed = piece
+        squares[to_sq] = placed
+        self.hash = (prev_hash ^ ZOBRIST_PIECE_SQUARE[piece][from_sq] ^ ZOBRIST_PIECE_SQUARE[placed][to_sq]
+                     ^ ZOBRIST_PIECE_SQUARE[captured][to_sq] ^ ZOBRIST_BLACK_TO_MOVE)
+        undo = (move, piece, captured, prev_hash, self.mg_score, self.eg_score, self.phase)
+        self.mg_score += EVAL_MG[placed][to_sq] - EVAL_MG[piece][from_sq] - EVAL_MG[captured][to_sq]
+        self.eg_score += EVAL_EG[placed][to_sq] - EVAL_EG[piece][from_sq] - EVAL_EG[captured][to_sq]
+        if captured != EMPTY or placed != piece:
+            self.phase += PHASE_OF_CODE[placed] - PHASE_OF_CODE[piece] - PHASE_OF_CODE[captured]
+            if captured != EMPTY:
+                self.piece_count -= 1
+        if piece & 7 == KING:
+            self.king_squares[piece >> 3] = to_sq
+        if captured & 7 == KING:
+            self.king_squares[captured >> 3] = -1
+        self.white_to_move = not self.white_to_move
+        return undo
+
+    def unmake_move(self, undo):
+        move, piece, captured, self.hash, self.mg_score, self.eg_score, self.phase = undo
+        from_sq = move & 127
+        to_sq = (move >> 7) & 127
+        squares = self.squares
+        squares[from_sq] = piece
+        squares[to_sq] = captured
+        if piece & 7 == KING:
+            self.king_squares[piece >> 3] = from_sq
+        if captured != EMPTY:
+            self.piece_count += 1
+            if captured & 7 == KING:
+                self.king_squares[captured >> 3] = to_sq
+        self.white_to_move = not self.white_to_move
+
+    def piece_targets(self, from_sq):
+        # Pseudo-legal destination squares for the piece on from_sq (either colour)
+        squares = self.squares
+        piece = squares[from_sq]
+        piece_type = piece & 7
+        own_colour = piece & BLACK_BIT
+        targets = []
+        if piece_type == PAWN:
+            forward = 16 if own_colour else -16
+            to_sq = from_sq + forward
+            if not to_sq & 0x88 and squares[to_sq] == EMPTY:
+                targets.append(to_sq)
+                start_row = 1 if own_colour else 6
+                if (from_sq >> 4) == start_row and squares[to_sq + forward] == EMPTY:
+                    targets.append(to_sq + forward)
+            for to_sq in (from_sq + forward - 1, from_sq + forward + 1):
+                if not to_sq & 0x88:
+                    target = squares[to_sq]
+                    if target != EMPTY and (target & BLACK_BIT) != own_colour:
+                        targets.append(to_sq)
+        elif piece_type == KNIGHT or piece_type == KING:
+            for offset in (KNIGHT_OFFSETS if piece_type == KNIGHT else KING_OFFSETS):
+                to_sq = from_sq + offset
+                if not to_sq & 0x88:
+                    target = squares[to_sq]
+                    if target == EMPTY or (target & BLACK_BIT) != own_colour:
+                        targets.append(to_sq)
+        elif piece_type != EMPTY:
+            for direction in SLIDER_DIRECTIONS[piece_type]:
+                to_sq = from_sq + direction
+                while not to_sq & 0x88:
+                    target = squares[to_sq]
+                    if target == EMPTY:
+                        targets.append(to_sq)
+                    else:
+                        if (target & BLACK_BIT) != own_colour:
+                            targets.append(to_sq)
+                        break
+                    to_sq += direction
+        return targets
+
+    def is_square_attacked(self, sq, by_white):
+        return square_attacked(self.squares, sq, by_white)
+
+    def is_in_check(self, king_is_white=None):
+        # A missing king counts as being in check, same as is_in_check()
+        if king_is_white is None:
+            king_is_white = self.white_to_move
+        king_sq = self.king_squares[0 if king_is_white else 1]
+        if king_sq < 0:
+            return True
+        return square_attacked(self.squares, king_sq, not king_is_white)
+
+    def pseudo_moves(self, from_sq=None):
+        own_colour = 0 if self.white_to_move else BLACK_BIT
+        squares = self.squares
+        moves = []
+        for sq in (BOARD_SQUARES if from_sq is None else (from_sq,)):
+            piece = squares[sq]
+            if piece != EMPTY and (piece & BLACK_BIT) == own_colour:
+                for to_sq in self.piece_targets(sq):
+                    moves.append(sq | (to_sq << 7))
+        return moves
+
+    def capture_targets(self, from_sq):
+        # The subset of piece_targets that captures or promotes, found without
+        # walking the quiet squares of knights and kings
+        squares = self.squares
+        piece = squares[from_sq]
+        piece_type = piece & 7
+        own_colour = piece & BLACK_BIT
+        targets = []
+        if piece_type == PAWN:
+            forward = 16 if own_colour else -16
+            to_sq = from_sq + forward
+            if (to_sq >> 4) in (0, ROWS - 1) and squares[to_sq] == EMPTY:
+                targets.append(to_sq)
+            for to_sq in (from_sq + forward - 1, from_sq + forward + 1):
+                if not to_sq & 0x88:
+                    target = squares[to_sq]
+                    if target != EMPTY and (target & BLACK_BIT) != own_colour:
+                        targets.append(to_sq)
+        elif piece_type == KNIGHT or piece_type == KING:
+            for to_sq in (KNIGHT_JUMPS if piece_type == KNIGHT else KING_JUMPS)[from_sq]:
+                target = squares[to_sq]
+                if target != EMPTY and (target & BLACK_BIT) != own_colour:
+                    targets.append(to_sq)
+        elif piece_type != EMPTY:
+            for direction in SLIDER_DIRECTIONS[piece_type]:
+                to_sq = from_sq + direction
+                while not to_sq & 0x88:
+                    target = squares[to_sq]
+                    if target != EMPTY:
+                        if (target & BLACK_BIT) != own_colour:
+                            targets.append(to_sq)
+                        break
+                    to_sq += direction
+        return targets
+
+    def check_info(self):
+        # For the side to move: (king square, evasion squares, pins). Evasion
+        # squares is None when not in check, else the squares that capture or
+        # block the single checker (empty in double check). Pins maps each
+        # pinned piece's square to the squares it can move to without exposing
+        # the king. Returns None when the side to move has no king.
+        king_sq = self.king_squares[0 if self.white_to_move else 1]
+        if king_sq < 0:
+            return None
+        squares = self.squares
+        own_colour = 0 if self.white_to_move else BLACK_BIT
+        enemy_colour = own_colour ^ BLACK_BIT
+        checkers = []
+        evasions = None
+        knight = KNIGHT | enemy_colour
+        for from_sq in KNIGHT_JUMPS[king_sq]:
+            if squares[from_sq] == knight:
+                checkers.append((from_sq,))
+        pawn = PAWN | enemy_colour
+        for from_sq in PAWN_ATTACKER_SQUARES[enemy_colour >> 3][king_sq]:
+            if squares[from_sq] == pawn:
+                checkers.append((from_sq,))
+        king = KING | enemy_colour
+        for from_sq in KING_JUMPS[king_sq]:
+            if squares[from_sq] == king:
+                checkers.append((from_sq,))
+        pins = {}
+        queen = QUEEN | enemy_colour
+        for rays, slider in ((ROOK_RAYS[king_sq], ROOK | enemy_colour), (BISHOP_RAYS[king_sq], BISHOP | enemy_colour)):
+            for ray in rays:
+                shield = -1 # First own piece met along the ray
+                for index, sq in enumerate(ray):
+                    piece = squares[sq]
+                    if piece == EMPTY:
+                        continue
+                    if (piece & BLACK_BIT) == own_colour:
+                        if shield >= 0:
+                            break
+                        shield = sq
+                        continue
+                    if piece == slider or piece == queen:
+                        if shield >= 0:
+                            pins[shield] = ray[:index + 1]
+                        else:
+                            checkers.append(ray[:index + 1])
+                    break
+        if checkers:
+            evasions = set(checkers[0]) if len(checkers) == 1 else set()
+        return king_sq, evasions, pins
+
+    def _is_legal_target(self, from_sq, to_sq, info):
+        # Legality of a pseudo-legal move given this position's check_info()
+        king_sq, evasions, pins = info
+        if from_sq == king_sq:
+            squares = self.squares
+            king = squares[king_sq]
+            squares[king_sq] = EMPTY # The king mustn't shield the square it steps back onto
+            attacked = square_attacked(squares, to_sq, not self.white_to_move)
+            squares[king_sq] = king
+            return not attacked
+        if evasions is not None and to_sq not in evasions:
+            return False
+        pin_ray = pins.get(from_sq)
+        return pin_ray is None or to_sq in pin_ray
+
+    def is_legal_move(self, move, info=None):
+        # Validates a move from outside the generator, e.g. a transposition table
+        # move. info is this position's check_info(), if the caller has it already.
+        if move >> 14:
+            return False
+        from_sq = move & 127
+        to_sq = (move >> 7) & 127
+        piece = self.squares[from_sq]
+        if piece == EMPTY or (piece & BLACK_BIT) != (0 if self.white_to_move else BLACK_BIT):
+            return False
+        if to_sq not in self.piece_targets(from_sq):
+            return False
+        if info is None:
+            info = self.check_info()
+        return info is not None and self._is_legal_target(from_sq, to_sq, info)
+
+    def legal_moves(self, from_sq=None):
+        # Pseudo-moves filtered by the pin and check masks, in generation order
+        info = self.check_info()
+        if info is None:
+            return []
+        is_legal_target = self._is_legal_target
+        legal = []
+        for move in self.pseudo_moves(from_sq):
+            if is_legal_target(move & 127, move >> 7, info):
+                legal.append(move)
+        return legal
+
+    def staged_legal_moves(self, hash_move=0, ctx=None, ply=0):
+        # Yields legal moves lazily, best candidates first: the hash move, then
+        # captures and promotions by MVV-LVA, then quiet moves by killers and
+        # history. Each stage is only generated once the previous one is used
+        # up, so a cutoff on an early move skips the rest. The order matches
+        # order_moves() on the full list. The caller may make and unmake moves
+        # between items, as long as the position is restored before the next one.
+        info = self.check_info()
+        if info is None:
+            return
+        if hash_move and self.is_legal_move(hash_move, info):
+            yield hash_move
+        else:
+            hash_move = 0
+
+        for move in self._ordered_captures(info, hash_move):
+            yield move
+
+        if ctx is not None and ply < MAX_PLY:
+            killer_1, killer_2 = ctx.killers[ply]
+            history = ctx.history
+        else:
+            killer_1 = killer_2 = 0
+            history = None
+        squares = self.squares
+        own_colour = 0 if self.white_to_move else BLACK_BIT
+        is_legal_target = self._is_legal_target
+        king_sq, evasions, _ = info
+        only_king_moves = evasions is not None and not evasions # Double check
+        quiets = []
+        for from_sq in BOARD_SQUARES:
+            piece = squares[from_sq]
+            if piece == EMPTY or (piece & BLACK_BIT) != own_colour:
+                continue
+            if only_king_moves and from_sq != king_sq:
+                continue
+            promotion_row = (0 if own_colour == 0 else ROWS - 1) if piece & 7 == PAWN else -1
+            for to_sq in self.piece_targets(from_sq):
+                if squares[to_sq] != EMPTY or (to_sq >> 4) == promotion_row:
+                    continue
+                move = from_sq | (to_sq << 7)
+                if move == hash_move or not is_legal_target(from_sq, to_sq, info):
+                    continue
+                if move == killer_1:
+                    key = ORDER_KILLER + 1
+                elif move == killer_2:
+                    key = ORDER_KILLER
+                else:
+                    key = history[(piece << 7) | to_sq] if history is not None else 0
+                quiets.append((key, move))
+        quiets.sort(key=_stage_key, reverse=True)
+        for _, move in quiets:
+            yield move
+
+    def _ordered_captures(self, info, skip_move=0):
+        # Legal captures and promotions, most valuable victim / least valuable attacker first
+        squares = self.squares
+        own_colour = 0 if self.white_to_move else BLACK_BIT
+        is_legal_target = self._is_legal_target
+        king_sq, evasions, _ = info
+        only_king_moves = evasions is not None and not evasions # Double check
+        captures = []
+        for from_sq in BOARD_SQUARES:
+            piece = squares[from_sq]
+            if piece == EMPTY or (piece & BLACK_BIT) != own_colour:
+                continue
+            if only_king_moves and from_sq != king_sq:
+                continue
+            attacker_value = PIECE_CODE_VALUES[piece]
+            for to_sq in self.capture_targets(from_sq):
+                move = from_sq | (to_sq << 7)
+                if move != skip_move and is_legal_target(from_sq, to_sq, info):
+                    victim = squares[to_sq]
+                    if victim != EMPTY:
+                        captures.append((PIECE_CODE_VALUES[victim] * 1024 - attacker_value, move))
+                    else:
+                        captures.append(((PIECE_VALUES["q"] - PIECE_VALUES["p"]) * 1024, move))
+        captures.sort(key=_stage_key, reverse=True)
+        return [move for _, move in captures]
+
+    def has_legal_move(self):
+        # Stops at the first legal move, with no ordering or move list
+        info = self.check_info()
+        if info is None:
+            return False
+        squares = self.squares
+        own_colour = 0 if self.white_to_move else BLACK_BIT
+        is_legal_target = self._is_legal_target
+        king_sq, evasions, _ = info
+        if evasions is not None and not evasions: # Double check: only the king can move
+            return any(is_legal_target(king_sq, to_sq, info) for to_sq in self.piece_targets(king_sq))
+        for from_sq in BOARD_SQUARES:
+            piece = squares[from_sq]
+            if piece == EMPTY or (piece & BLACK_BIT) != own_colour:
+                continue
+            for to_sq in self.piece_targets(from_sq):
+                if is_legal_target(from_sq, to_sq, info):
+                    return True
+        return False
+
+    def evaluate(self):
+        # O(1): blends the running midgame and endgame scores by phase
+        phase = self.phase if self.phase < MAX_PHASE else MAX_PHASE
+        return (self.mg_score * phase + self.eg_score * (MAX_PHASE - phase)) // MAX_PHASE
+
+def _stage_key(keyed_move):
+    return keyed_move[0]
+
+PIECE_CODE_VALUES = [0] * 16
+for _piece_char, _piece_code in PIECE_CODES.items():
+    PIECE_CODE_VALUES[_piece_code] = PIECE_VALUES[_piece_char.lower()]
+
+# --- Incremental Evaluation ---
+# Piece-square tables in PIECE_VALUES units (a pawn is 10), written from White's
+# side with row 0 at the top like the board. Black uses the mirrored row.
+# Midgame and endgame scores are blended by game phase.
+PAWN_TABLE_MG = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+     5,  5,  5,  5,  5,  5,  5,  5,
+     1,  1,  2,  3,  3,  2,  1,  1,
+     0,  0,  1,  2,  2,  1,  0,  0,
+     0,  0,  0,  2,  2,  0,  0,  0,
+     0,  0, -1,  0,  0, -1,  0,  0,
+     0,  1,  1, -2, -2,  1,  1,  0,
+     0,  0,  0,  0,  0,  0,  0,  0]
+PAWN_TABLE_EG = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+     8,  8,  8,  8,  8,  8,  8,  8,
+     5,  5,  5,  5,  5,  5,  5,  5,
+     3,  3,  3,  3,  3,  3,  3,  3,
+     2,  2,  2,  2,  2,  2,  2,  2,
+     1,  1,  1,  1,  1,  1,  1,  1,
+     0,  0,  0,  0,  0,  0,  0,  0,
+     0,  0,  0,  0,  0,  0,  0,  0]
+KNIGHT_TABLE = [
+    -5, -4, -3, -3, -3, -3, -4, -5,
+    -4, -2,  0,  0,  0,  0, -2, -4,
+    -3,  0,  1,  2,  2,  1,  0, -3,
+    -3,  1,  2,  2,  2,  2,  1, -3,
+    -3,  0,  2,  2,  2,  2,  0, -3,
+    -3,  1,  1,  2,  2,  1,  1, -3,
+    -4, -2,  0,  1,  1,  0, -2, -4,
+    -5, -4, -3, -3, -3, -3, -4, -5]
+BISHOP_TABLE = [
+    -2, -1, -1, -1, -1, -1, -1, -2,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+    -1,  0,  1,  1,  1,  1,  0, -1,
+    -1,  1,  1,  1,  1,  1,  1, -1,
+    -1,  0,  1,  1,  1,  1,  0, -1,
+    -1,  1,  1,  1,  1,  1,  1, -1,
+    -1,  1,  0,  0,  0,  0,  1, -1,
+    -2, -1, -1, -1, -1, -1, -1, -2]
+ROOK_TABLE = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+     1,  1,  1,  1,  1,  1,  1,  1,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+     0,  0,  0,  1,  1,  0,  0,  0]
+QUEEN_TABLE = [
+    -2, -1, -1,  0,  0, -1, -1, -2,
+    -1,  0,  0,  0,  0,  0,  0, -1,
+    -1,  0,  1,  1,  1,  1,  0, -1,
+     0,  0,  1,  1,  1,  1,  0,  0,
+     0,  0,  1,  1,  1,  1,  0,  0,
+    -1,  1,  1,  1,  1,  1,  0, -1,
+    -1,  0,  1,  0,  0,  0,  0, -1,
+    -2, -1, -1,  0,  0, -1, -1, -2]
+KING_TABLE_MG = [
+    -3, -4, -4, -5, -5, -4, -4, -3,
+    -3, -4, -4, -5, -5, -4, -4, -3,
+    -3, -4, -4, -5, -5, -4, -4, -3,
+    -3, -4, -4, -5, -5, -4, -4, -3,
+    -2, -3, -3, -4, -4, -3, -3, -2,
+    -1, -2, -2, -2, -2, -2, -2, -1,
+     2,  2,  0,  0,  0,  0,  2,  2,
+     2,  3,  1,  0,  0,  1,  3,  2]
+KING_TABLE_EG = [
+    -5, -4, -3, -2, -2, -3, -4, -5,
+    -3, -2, -1,  0,  0, -1, -2, -3,
+    -3, -1,  2,  3,  3,  2, -1, -3,
+    -3, -1,  3,  4,  4,  3, -1, -3,
+    -3, -1,  3,  4,  4,  3, -1, -3,
+    -3, -1,  2,  3,  3,  2, -1, -3,
+    -3, -3,  0,  0,  0,  0, -3, -3,
+    -5, -3, -3, -3, -3, -3, -3, -5]
+PIECE_SQUARE_TABLES = { # piece type: (midgame table, endgame table)
+    PAWN: (PAWN_TABLE_MG, PAWN_TABLE_EG), KNIGHT: (KNIGHT_TABLE, KNIGHT_TABLE),
+    BISHOP: (BISHOP_TABLE, BISHOP_TABLE), ROOK: (ROOK_TABLE, ROOK_TABLE),
+    QUEEN: (QUEEN_TABLE, QUEEN_TABLE), KING: (KING_TABLE_MG, KING_TABLE_EG)
+}
+USE_PIECE_SQUARE_TABLES = True # False leaves a pure material count, identical to the old evaluate_board
+
+PHASE_WEIGHTS = {KNIGHT: 1, BISHOP: 1, ROOK: 2, QUEEN: 4} # Full set of these = midgame
+MAX_PHASE = 24
+
+# Signed (White positive) material + table score per [piece code][0x88 square]
+EVAL_MG = [[0] * 128 for _ in range(16)]
+EVAL_EG = [[0] * 128 for _ in range(16)]
+PHASE_OF_CODE = [0] * 16
+
+def set_piece_square_tables(enabled):
+    # Rebuilds the evaluation tables in place. Positions built earlier keep
+    # their old running scores, so call this before creating any.
+    for piece_code in PIECE_CODES.values():
+        piece_type = piece_code & 7
+        if piece_type == EMPTY:
+            continue
+        sign = -1 if piece_code & BLACK_BIT else 1
+        mg_table, eg_table = PIECE_SQUARE_TABLES[piece_type]
+        PHASE_OF_CODE[piece_code] = PHASE_WEIGHTS.get(piece_type, 0)
+        for sq in BOARD_SQUARES:
+            row, col = sq >> 4, sq & 7
+            table_index = ((ROWS - 1 - row) if sign < 0 else row) * COLS + col
+            value = PIECE_CODE_VALUES[piece_code]
+            EVAL_MG[piece_code][sq] = sign * (value + (mg_table[table_index] if enabled else 0))
+            EVAL_EG[piece_code][sq] = sign * (value + (eg_table[table_index] if enabled else 0))
+
+set_piece_square_tables(USE_PIECE_SQUARE_TABLES)
+
+
+# --- Move Notation ---
+def square_name(sq):
+    return "abcdefgh"[sq & 7] + str(ROWS - (sq >> 4))
+
+def move_to_uci(position, move):
+    # Coordinate notation such as "e2e4", or "e7e8q" for a promotion
+    from_sq = move & 127
+    to_sq = (move >> 7) & 127
+    text = square_name(from_sq) + square_name(to_sq)
+    if position.squares[from_sq] & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1):
+        text += CODE_TO_PIECE[((move >> 14) or QUEEN) | BLACK_BIT]
+    return text
+
+def move_to_san(position, move):
+    # Standard algebraic notation for a legal move in position
+    squares = position.squares
+    from_sq = move & 127
+    to_sq = (move >> 7) & 127
+    piece = squares[from_sq]
+    piece_type = piece & 7
+    is_capture = squares[to_sq] != EMPTY
+    if piece_type == PAWN:
+        san = (square_name(from_sq)[0] + "x" if is_capture else "") + square_name(to_sq)
+        if (to_sq >> 4) in (0, ROWS - 1):
+            san += "=" + CODE_TO_PIECE[(move >> 14) or QUEEN].upper()
+    else:
+        rivals = [other & 127 for other in position.legal_moves()
+                  if (other >> 7) & 127 == to_sq and other & 127 != from_sq and squares[other & 127] == piece]
+        disambiguation = ""
+        if rivals:
+            if all((rival & 7) != (from_sq & 7) for rival in rivals):
+                disambiguation = square_name(from_sq)[0]
+            elif all((rival >> 4) != (from_sq >> 4) for rival in rivals):
+                disambiguation = square_name(from_sq)[1]
+            else:
+                disambiguation = square_name(from_sq)
+        san = CODE_TO_PIECE[piece].upper() + disambiguation + ("x" if is_capture else "") + square_name(to_sq)
+    undo = position.make_move(move)
+    if position.is_in_check():
+        san += "+" if position.has_legal_move() else "#"
+    position.unmake_move(undo)
+    return san
 
 def create_board():
     # Standard chess starting position
@@ -59,6 +784,11 @@ def get_square_under_mouse(mouse_pos):
 
 def move_piece(board, start_pos, end_pos, promotion_piece='Q'):
     # Moves a piece on the board and handles pawn promotion
+    if isinstance(board, Position):
+        piece_code = board.squares[(start_pos[0] << 4) | start_pos[1]]
+        board.make_move(coords_to_move(start_pos, end_pos, PIECE_CODES[promotion_piece.upper()]))
+        return CODE_TO_PIECE[piece_code]
+
     start_row, start_col = start_pos
     end_row, end_col = end_pos
     
@@ -84,159 +814,230 @@ def find_king(board, king_is_white):
     return None
 
 def is_square_attacked(board, square_pos_to_check, attacker_is_white):
-    # Checks if a given square is attacked by the attacker's pieces
-    attacker_turn_str = "White" if attacker_is_white else "Black"
-    for r_idx in range(ROWS):
-        for c_idx in range(COLS):
-            piece = board[r_idx][c_idx]
-            if piece == ".":
-                continue
-            
-            piece_is_white_on_board = piece.isupper()
-            if piece_is_white_on_board == attacker_is_white:
-                moves = get_valid_moves(board, (r_idx, c_idx), attacker_turn_str, ignore_checks=True)
-                if square_pos_to_check in moves:
-                    return True
-    return False
+    # Checks if a given square is attacked by the attacker's pieces. This means
+    # "could capture there", not "has a move there", which differs from the old
+    # move-list scan in two ways: pawns attack their two diagonals whether or not
+    # anything stands there (and not the squares straight ahead), and squares
+    # held by the attacker's own pieces count as attacked when they are defended.
+    # The answer for a king's square, and so every check test, is unchanged.
+    position = as_position(board, attacker_is_white)
+    row, col = square_pos_to_check
+    return square_attacked(position.squares, (row << 4) | col, attacker_is_white)
 
 def get_valid_moves(board, piece_pos, current_player_turn_str, ignore_checks=False):
-    # Calculates valid moves for a piece at piece_pos
+    # Calculates valid moves for a piece at piece_pos (adapter over Position)
     row, col = piece_pos
-    piece_char = board[row][col]
-    pseudo_moves = [] 
+    position = as_position(board, current_player_turn_str == "White")
+    from_sq = (row << 4) | col
+    piece = position.squares[from_sq]
 
-    if piece_char == ".":
-        return [] 
-    
-    piece_is_white = piece_char.isupper()
-    
-    if not ((current_player_turn_str == "White" and piece_is_white) or \
-            (current_player_turn_str == "Black" and not piece_is_white)):
+    if piece == EMPTY:
         return []
 
-    piece_type = piece_char.lower()
-
-    if piece_type == "p":
-        direction = -1 if piece_is_white else 1
-        start_row_for_double_move = 6 if piece_is_white else 1
-        if 0 <= row + direction < ROWS and board[row + direction][col] == ".":
-            pseudo_moves.append((row + direction, col))
-            if row == start_row_for_double_move and board[row + 2 * direction][col] == ".":
-                pseudo_moves.append((row + 2 * direction, col))
-        for capture_col_offset in [-1, 1]:
-            nr, nc = row + direction, col + capture_col_offset
-            if 0 <= nr < ROWS and 0 <= nc < COLS:
-                target_piece = board[nr][nc]
-                if target_piece != "." and target_piece.isupper() != piece_is_white:
-                    pseudo_moves.append((nr, nc))
-
-    elif piece_type == "n":
-        knight_move_offsets = [
-            (-2, -1), (-2, 1), (-1, -2), (-1, 2),
-            (1, -2), (1, 2), (2, -1), (2, 1)
-        ]
-        for dr, dc in knight_move_offsets:
-            nr, nc = row + dr, col + dc
-            if 0 <= nr < ROWS and 0 <= nc < COLS:
-                target_piece = board[nr][nc]
-                if target_piece == "." or target_piece.isupper() != piece_is_white:
-                    pseudo_moves.append((nr, nc))
-
-    elif piece_type in ["r", "b", "q"]:
-        directions = []
-        if piece_type == "r": directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-        elif piece_type == "b": directions = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-        elif piece_type == "q": directions = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
-        
-        for dr, dc in directions:
-            nr, nc = row, col
-            while True:
-                nr += dr
-                nc += dc
-                if 0 <= nr < ROWS and 0 <= nc < COLS:
-                    target_piece = board[nr][nc]
-                    if target_piece == ".": pseudo_moves.append((nr, nc))
-                    elif target_piece.isupper() != piece_is_white:
-                        pseudo_moves.append((nr, nc)); break
-                    else: break
-                else: break
-    
-    elif piece_type == "k":
-        king_move_offsets = [
-            (-1,-1),(-1,0),(-1,1),(0,-1),(0,1),(1,-1),(1,0),(1,1)
-        ]
-        for dr, dc in king_move_offsets:
-            nr, nc = row + dr, col + dc
-            if 0 <= nr < ROWS and 0 <= nc < COLS:
-                target_piece = board[nr][nc]
-                if target_piece == "." or target_piece.isupper() != piece_is_white:
-                    pseudo_moves.append((nr, nc))
+    # Only the side to move's pieces have moves
+    if (piece & BLACK_BIT) != (0 if position.white_to_move else BLACK_BIT):
+        return []
 
     if ignore_checks:
-        return pseudo_moves
+        moves = position.pseudo_moves(from_sq)
     else:
-        legal_moves = []
-        for move_end_pos in pseudo_moves:
-            temp_board = [r.copy() for r in board]
-            move_piece(temp_board, piece_pos, move_end_pos)
-            king_owner_is_white = piece_is_white
-            if not is_in_check(temp_board, king_owner_is_white):
-                legal_moves.append(move_end_pos)
-        return legal_moves
+        moves = position.legal_moves(from_sq)
+    return [move_to_coords(move)[1] for move in moves]
 
 def is_in_check(board, current_player_king_is_white):
-    king_pos = find_king(board, current_player_king_is_white)
-    if not king_pos: return True 
-    opponent_is_white = not current_player_king_is_white
-    return is_square_attacked(board, king_pos, opponent_is_white)
+    return as_position(board, current_player_king_is_white).is_in_check(current_player_king_is_white)
 
 def get_all_legal_moves_for_player(board, player_turn_str):
-    all_moves = []
     player_is_white = (player_turn_str == "White")
-    for r_idx in range(ROWS):
-        for c_idx in range(COLS):
-            piece_char = board[r_idx][c_idx]
-            if piece_char != ".":
-                piece_is_white_on_board = piece_char.isupper()
-                if piece_is_white_on_board == player_is_white:
-                    moves = get_valid_moves(board, (r_idx, c_idx), player_turn_str, ignore_checks=False)
-                    for move in moves:
-                        all_moves.append(((r_idx, c_idx), move))
-    return all_moves
+    position = as_position(board, player_is_white)
+    return [move_to_coords(move) for move in position.legal_moves()]
 
 def has_any_legal_moves(board, player_turn_str):
-    return bool(get_all_legal_moves_for_player(board, player_turn_str))
+    return as_position(board, player_turn_str == "White").has_legal_move()
+
+class BoardRenderer:
+    # Rendering cache for draw_board: fonts are loaded once, the 12 piece glyphs
+    # live in one pre-rendered atlas, and the empty board is drawn once. The
+    # renderer remembers what each square showed last frame and only redraws
+    # squares that changed.
+    def __init__(self):
+        _pygame()
+        try:
+            piece_font = pygame.font.SysFont("Segoe UI Symbol", 48)
+        except pygame.error:
+            piece_font = pygame.font.SysFont("arial", 48)
+        self.message_font = pygame.font.SysFont("arial", 30, bold=True)
+
+        self.background = pygame.Surface((WIDTH, HEIGHT))
+        for r in range(ROWS):
+            for c in range(COLS):
+                square_color = WHITE_SQUARE_COLOR if (r + c) % 2 == 0 else BLACK_SQUARE_COLOR
+                pygame.draw.rect(self.background, square_color, (c * SQUARE_SIZE, r * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
+
+        # Glyph atlas: one square-sized cell per piece, glyph centred in its cell
+        self.atlas = pygame.Surface((SQUARE_SIZE * len(PIECES), SQUARE_SIZE), pygame.SRCALPHA)
+        self.glyph_areas = {}
+        for index, (piece_char, glyph) in enumerate(PIECES.items()):
+            text_surface = piece_font.render(glyph, True, PIECE_TEXT_COLOR)
+            cell = pygame.Rect(index * SQUARE_SIZE, 0, SQUARE_SIZE, SQUARE_SIZE)
+            self.atlas.blit(text_surface, text_surface.get_rect(center=cell.center))
+            self.glyph_areas[piece_char] = cell
+
+        self.highlight = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
+        pygame.draw.circle(self.highlight, (*HIGHLIGHT_COLOR, 100),
+                           (SQUARE_SIZE // 2, SQUARE_SIZE // 2), SQUARE_SIZE // 5)
+        self.message_boxes = {} # Message text -> (background box, rendered text)
+        self.target = None # Surface drawn to last frame
+        self.square_states = [None] * (ROWS * COLS) # (piece, selected, highlighted) per square
+        self.message = ""
+
+    def message_box(self, msg_str):
+        surfaces = self.message_boxes.get(msg_str)
+        if surfaces is None:
+            text_surface = self.message_font.render(msg_str, True, CHECK_TEXT_COLOR)
+            box = pygame.Surface((text_surface.get_width() + 20, text_surface.get_height() + 10), pygame.SRCALPHA)
+            box.fill(MESSAGE_BG_COLOR)
+            surfaces = self.message_boxes[msg_str] = (box, text_surface)
+        return surfaces
+
+    def message_rect(self, msg_str):
+        if not msg_str:
+            return None
+        return self.message_box(msg_str)[0].get_rect(center=(WIDTH // 2, HEIGHT // 2))
+
+    @staticmethod
+    def squares_under(rect):
+        if rect is None:
+            return set()
+        rows = range(max(0, rect.top // SQUARE_SIZE), min(ROWS, (rect.bottom - 1) // SQUARE_SIZE + 1))
+        cols = range(max(0, rect.left // SQUARE_SIZE), min(COLS, (rect.right - 1) // SQUARE_SIZE + 1))
+        return {r * COLS + c for r in rows for c in cols}
+
+    def draw(self, win, board, selected_piece_coords, valid_moves_for_selected, msg_str):
+        # Draws what changed since the last call and returns the dirty rects
+        states = [(board[r][c], selected_piece_coords == (r, c), (r, c) in valid_moves_for_selected)
+                  for r in range(ROWS) for c in range(COLS)]
+        full_redraw = win is not self.target
+        if full_redraw:
+            dirty = set(range(ROWS * COLS))
+            self.target = win
+        else:
+            dirty = {index for index in range(ROWS * COLS) if states[index] != self.square_states[index]}
+        message_rect = self.message_rect(msg_str)
+        if msg_str != self.message:
+            # The box is translucent, so the squares under it are redrawn before it is blitted again
+            dirty |= self.squares_under(self.message_rect(self.message)) | self.squares_under(message_rect)
+        elif dirty & self.squares_under(message_rect):
+            dirty |= self.squares_under(message_rect)
+
+        dirty_rects = []
+        for index in dirty:
+            r, c = divmod(index, COLS)
+            square_rect = pygame.Rect(c * SQUARE_SIZE, r * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+            piece_char, is_selected, is_highlighted = states[index]
+            if is_selected: # Only relevant for human player
+                win.fill(SELECTED_COLOR, square_rect)
+            else:
+                win.blit(self.background, square_rect, square_rect)
+            if is_highlighted: # Only relevant for human player
+                win.blit(self.highlight, square_rect)
+            if piece_char != ".":
+                win.blit(self.atlas, square_rect, self.glyph_areas[piece_char])
+            dirty_rects.append(square_rect)
+        if message_rect is not None and dirty & self.squares_under(message_rect):
+            box, text_surface = self.message_box(msg_str)
+            win.blit(box, message_rect)
+            win.blit(text_surface, text_surface.get_rect(center=message_rect.center))
+
+        self.square_states = states
+        self.message = msg_str
+        return [win.get_rect()] if full_redraw else dirty_rects
+
+_board_renderer = None
+
+# --- Game State ---
+class GameState:
+    # Owns the board, side to move and move history for the GUI. Legal moves,
+    # check and game-over status are computed once per position and cached
+    # until the next make_move, instead of being re-derived every frame.
+    def __init__(self, board=None, current_player_turn="White"):
+        self.board = [row.copy() for row in (board or create_board())] # List board for drawing and clicks
+        self.position = Position.from_board(self.board, current_player_turn == "White")
+        self.move_history = [] # ((start_row, start_col), (end_row, end_col)) per move played
+        self.in_book = True # Until the opening book first has no move for the position
+        self._invalidate()
+
+    def _invalidate(self):
+        self._legal_moves = None
+        self._moves_by_square = None
+        self._is_check = None
+
+    @property
+    def current_player_turn(self):
+        return self.position.turn_str()
+
+    def legal_moves(self):
+        # Packed legal moves for the side to move; shared, so don't modify the list
+        if self._legal_moves is None:
+            self._legal_moves = self.position.legal_moves()
+        return self._legal_moves
+
+    def valid_moves_from(self, piece_pos):
+        # End squares of the legal moves starting at piece_pos (the human-click path)
+        if self._moves_by_square is None:
+            self._moves_by_square = {}
+            for move in self.legal_moves():
+                start_pos, end_pos = move_to_coords(move)
+                self._moves_by_square.setdefault(start_pos, []).append(end_pos)
+        return self._moves_by_square.get(piece_pos, [])
+
+    def is_check(self):
+        if self._is_check is None:
+            self._is_check = self.position.is_in_check()
+        return self._is_check
+
+    def is_checkmate(self):
+        return not self.legal_moves() and self.is_check()
+
+    def is_stalemate(self):
+        return not self.legal_moves() and not self.is_check()
+
+    def is_game_over(self):
+        return not self.legal_moves()
+
+    def book_move(self):
+        # Opening book move as coords, or None. After the first miss the book
+        # isn't consulted again this game.
+        if not self.in_book:
+            return None
+        move = opening_book_move(self.position)
+        if move is None:
+            self.in_book = False
+            return None
+        return move_to_coords(move)
+
+    def tablebase_move(self):
+        # Perfect move as coords when the endgame tablebases cover the position, else None
+        move = tablebase_move(self.position)
+        return move_to_coords(move) if move is not None else None
+
+    def make_move(self, start_pos, end_pos):
+        move_piece(self.board, start_pos, end_pos)
+        self.position.make_move(coords_to_move(start_pos, end_pos))
+        self.move_history.append((start_pos, end_pos))
+        self._invalidate()
 
 def draw_board(win, board, selected_piece_coords=None, valid_moves_for_selected=[], 
                check_flag=False, checkmate_flag=False, stalemate_flag=False, 
                thinking_flag=False, thinking_player_color_str=None): # Added thinking_player_color_str
-    # Draws the entire game board, pieces, highlights, and messages
-    try:
-        piece_font = pygame.font.SysFont("Segoe UI Symbol", 48)
-    except pygame.error:
-        piece_font = pygame.font.SysFont("arial", 48)
-    
-    message_font = pygame.font.SysFont("arial", 30, bold=True)
-
-    for r in range(ROWS):
-        for c in range(COLS):
-            square_color = WHITE_SQUARE_COLOR if (r + c) % 2 == 0 else BLACK_SQUARE_COLOR
-            if selected_piece_coords == (r, c): # Only relevant for human player
-                square_color = SELECTED_COLOR
-            pygame.draw.rect(win, square_color, (c * SQUARE_SIZE, r * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
-
-            if (r, c) in valid_moves_for_selected: # Only relevant for human player
-                highlight_surface = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
-                pygame.draw.circle(highlight_surface, (*HIGHLIGHT_COLOR, 100), 
-                                   (SQUARE_SIZE // 2, SQUARE_SIZE // 2), SQUARE_SIZE // 5)
-                win.blit(highlight_surface, (c * SQUARE_SIZE, r * SQUARE_SIZE))
-            
-            piece_char = board[r][c]
-            if piece_char != ".":
-                text_surface = piece_font.render(PIECES[piece_char], True, PIECE_TEXT_COLOR)
-                text_rect = text_surface.get_rect(center=(c*SQUARE_SIZE + SQUARE_SIZE//2, 
-                                                          r*SQUARE_SIZE + SQUARE_SIZE//2))
-                win.blit(text_surface, text_rect)
+    # Draws the board, pieces, highlights, and messages. Only squares that changed
+    # since the last call are redrawn; the returned rects are what to pass to
+    # pygame.display.update.
+    global _board_renderer
+    if isinstance(board, Position):
+        board = board.to_board()
+    if _board_renderer is None:
+        _board_renderer = BoardRenderer()
     
     msg_str = ""
     if thinking_flag and thinking_player_color_str: # Use the passed color
@@ -257,105 +1058,2021 @@ def draw_board(win, board, selected_piece_coords=None, valid_moves_for_selected=
     elif check_flag:
         msg_str = "Check!"
     
-    if msg_str:
-        text_surface = message_font.render(msg_str, True, CHECK_TEXT_COLOR)
-        bg_width = text_surface.get_width() + 20
-        bg_height = text_surface.get_height() + 10
-        bg_surface = pygame.Surface((bg_width, bg_height), pygame.SRCALPHA)
-        bg_surface.fill(MESSAGE_BG_COLOR)
-        bg_rect = bg_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2))
-        win.blit(bg_surface, bg_rect)
-        text_rect = text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2))
-        win.blit(text_surface, text_rect)
+    return _board_renderer.draw(win, board, selected_piece_coords, valid_moves_for_selected, msg_str)
 
 # --- AI Functions ---
 def evaluate_board(board):
-    score = 0
-    for r in range(ROWS):
-        for c in range(COLS):
-            piece_char = board[r][c]
-            if piece_char != ".":
-                value = PIECE_VALUES.get(piece_char.lower(), 0)
-                if piece_char.isupper(): score += value
-                else: score -= value
-    return score
+    # Full rescan version of Position.evaluate(); material only when the tables are off
+    if not isinstance(board, Position):
+        board = Position.from_board(board)
+    return board.evaluate()
+
+# --- Transposition Table ---
+TT_EXACT, TT_LOWER, TT_UPPER = 1, 2, 3 # Bound types (score is exact, a lower bound or an upper bound)
+TT_ENTRY_BYTES = 16 # One 64-bit key plus one packed 64-bit data word
+_TT_SCORE_INF = (1 << 31) - 1 # Stands in for +/- math.inf in the packed score field
+
+class TranspositionTable:
+    # Fixed-size, directly indexed table of searched positions. Each slot packs
+    # move (17 bits), bound (2), depth (7), age (6) and score (32) into one word.
+    # Replacement keeps the deeper entry unless the slot is from an older search.
+    # A current_only table also ignores entries from older searches when probed,
+    # so invalidate() empties it without touching the arrays.
+    __slots__ = ("size", "keys", "data", "age", "current_only",
+                 "probes", "hits", "misses", "collisions", "stores", "overwrites")
+
+    def __init__(self, size_mb=TT_SIZE_MB, current_only=False):
+        self.size = max(1, int(size_mb * 1024 * 1024) // TT_ENTRY_BYTES)
+        self.keys = array("Q", [0]) * self.size
+        self.data = array("Q", [0]) * self.size
+        self.age = 0
+        self.current_only = current_only
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.probes = self.hits = self.misses = self.collisions = 0
+        self.stores = self.overwrites = 0
+
+    def clear(self):
+        self.keys = array("Q", [0]) * self.size
+        self.data = array("Q", [0]) * self.size
+        self.age = 0
+
+    def new_search(self):
+        # Entries from earlier searches become the first to be replaced
+        self.age = (self.age + 1) & 63
+
+    def invalidate(self):
+        # Same effect as clear() on a current_only table, in O(1). Once the age
+        # wraps, old entries could match again, so every 64th call clears for real.
+        self.new_search()
+        if self.age == 0:
+            self.clear()
+
+    def probe(self, key):
+        # Returns (depth, score, bound, move) or None
+        self.probes += 1
+        index = key % self.size
+        data = self.data[index]
+        if data == 0 or (self.current_only and ((data >> 26) & 63) != self.age):
+            self.misses += 1
+            return None
+        if self.keys[index] != key:
+            self.collisions += 1
+            return None
+        self.hits += 1
+        score = (data >> 32) - (1 << 31)
+        if score >= _TT_SCORE_INF: score = math.inf
+        elif score <= -_TT_SCORE_INF: score = -math.inf
+        return ((data >> 19) & 127, score, (data >> 17) & 3, data & 0x1FFFF)
+
+    def store(self, key, depth, score, bound, move):
+        index = key % self.size
+        old_data = self.data[index]
+        if old_data != 0 and self.keys[index] != key:
+            if ((old_data >> 26) & 63) == self.age and ((old_data >> 19) & 127) > depth:
+                return
+            self.overwrites += 1
+        self.stores += 1
+        if score == math.inf: score = _TT_SCORE_INF
+        elif score == -math.inf: score = -_TT_SCORE_INF
+        else: score = max(-_TT_SCORE_INF + 1, min(_TT_SCORE_INF - 1, int(score)))
+        self.keys[index] = key
+        self.data[index] = ((score + (1 << 31)) << 32) | (self.age << 26) | (min(depth, 127) << 19) \
+                           | (bound << 17) | (move & 0x1FFFF)
+
+    def stats(self, include_usage=False):
+        # include_usage adds the fraction of slots filled by the current search,
+        # which scans the whole table, so it is off by default
+        report = {
+            "size_mb": self.size * TT_ENTRY_BYTES / (1024 * 1024), "entries": self.size,
+            "probes": self.probes, "hits": self.hits, "misses": self.misses,
+            "collisions": self.collisions, "stores": self.stores, "overwrites": self.overwrites,
+            "hit_rate": self.hits / self.probes if self.probes else 0.0,
+        }
+        if include_usage:
+            age = self.age
+            report["usage"] = sum(1 for data in self.data if data and ((data >> 26) & 63) == age) / self.size
+        return report
+
+_transposition_table = None
+
+def get_transposition_table():
+    # Shared table used by get_ai_move, created on first use with TT_SIZE_MB
+    global _transposition_table
+    if _transposition_table is None:
+        _transposition_table = TranspositionTable(TT_SIZE_MB)
+    return _transposition_table
+
+# --- Search ---
+class SearchAborted(Exception):
+    # Raised from inside the search when its deadline passes
+    pass
+
+class SearchContext:
+    # Per-search state threaded through _minimax
+    __slots__ = ("tt", "deadline", "nodes", "stop_requested", "killers", "history",
+                 "quiescence_depth", "quiescence_nodes", "tablebase_hits")
+
+    def __init__(self, tt, deadline=math.inf, quiescence_depth=None):
+        self.tt = tt
+        self.deadline = deadline
+        self.nodes = 0 # Every node, quiescence nodes included
+        self.quiescence_depth = QUIESCENCE_DEPTH if quiescence_depth is None else quiescence_depth
+        self.quiescence_nodes = 0 # Nodes searched past the horizon
+        self.tablebase_hits = 0 # Nodes scored by the endgame tablebases
+        self.stop_requested = False # Set from another thread to cancel the search
+        self.killers = [[0, 0] for _ in range(MAX_PLY)] # Two quiet moves per ply that caused cutoffs
+        self.history = [0] * (16 << 7) # Cutoff credit per (piece code, to-square)
+
+    def record_cutoff(self, position, move, depth, ply):
+        # Quiet moves that cut off feed the killer and history tables
+        squares = position.squares
+        to_sq = (move >> 7) & 127
+        if squares[to_sq] != EMPTY:
+            return
+        if ply < MAX_PLY:
+            killers = self.killers[ply]
+            if killers[0] != move:
+                killers[1] = killers[0]
+                killers[0] = move
+        index = (squares[move & 127] << 7) | to_sq
+        self.history[index] += depth * depth
+        if self.history[index] >= HISTORY_MAX:
+            self.history = [value >> 1 for value in self.history]
+
+    def iteration_done(self, depth, score, move):
+        # Hook called after each completed iterative deepening depth
+        pass
+
+# Move ordering keys: hash move, then captures/promotions by MVV-LVA, then killers, then history
+ORDER_HASH_MOVE = 1 << 30
+ORDER_CAPTURE = 1 << 28
+ORDER_KILLER = 1 << 26
+HISTORY_MAX = 1 << 25
+
+def order_moves(position, moves, hash_move=0, ctx=None, ply=0):
+    # Sorts moves in place, best candidates first; ties keep their incoming order
+    squares = position.squares
+    if ctx is not None and ply < MAX_PLY:
+        killer_1, killer_2 = ctx.killers[ply]
+        history = ctx.history
+    else:
+        killer_1 = killer_2 = 0
+        history = None
+
+    def move_key(move):
+        if move == hash_move:
+            return ORDER_HASH_MOVE
+        from_sq = move & 127
+        to_sq = (move >> 7) & 127
+        piece = squares[from_sq]
+        victim = squares[to_sq]
+        if victim != EMPTY:
+            return ORDER_CAPTURE + PIECE_CODE_VALUES[victim] * 1024 - PIECE_CODE_VALUES[piece]
+        if piece & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1):
+            return ORDER_CAPTURE + (PIECE_VALUES["q"] - PIECE_VALUES["p"]) * 1024
+        if move == killer_1:
+            return ORDER_KILLER + 1
+        if move == killer_2:
+            return ORDER_KILLER
+        return history[(piece << 7) | to_sq] if history is not None else 0
+
+    moves.sort(key=move_key, reverse=True)
+    return moves
+
+# --- Quiescence Search ---
+DELTA_MARGIN = 20 # Two pawns: captures that can't lift the score this close to alpha are skipped
+
+def _least_valuable_attacker(squares, sq, colour):
+    # Square of the cheapest piece of colour attacking sq, or -1
+    pawn = PAWN | colour
+    for from_sq in PAWN_ATTACKER_SQUARES[colour >> 3][sq]:
+        if squares[from_sq] == pawn:
+            return from_sq
+    knight = KNIGHT | colour
+    for from_sq in KNIGHT_JUMPS[sq]:
+        if squares[from_sq] == knight:
+            return from_sq
+    for rays, slider in ((BISHOP_RAYS[sq], BISHOP | colour), (ROOK_RAYS[sq], ROOK | colour)):
+        for ray in rays:
+            for from_sq in ray:
+                if squares[from_sq] != EMPTY:
+                    if squares[from_sq] == slider:
+                        return from_sq
+                    break
+    queen = QUEEN | colour
+    for rays in (ROOK_RAYS[sq], BISHOP_RAYS[sq]):
+        for ray in rays:
+            for from_sq in ray:
+                if squares[from_sq] != EMPTY:
+                    if squares[from_sq] == queen:
+                        return from_sq
+                    break
+    king = KING | colour
+    for from_sq in KING_JUMPS[sq]:
+        if squares[from_sq] == king:
+            return from_sq
+    return -1
+
+def static_exchange(position, move):
+    # Material the side to move expects to win with move (in PIECE_VALUES units)
+    # if both sides keep recapturing on the target square with their cheapest
+    # piece and either may stop when that stops paying. Pieces are lifted off
+    # the board as they capture, so sliders behind them join in; pins are ignored.
+    squares = position.squares
+    from_sq = move & 127
+    to_sq = (move >> 7) & 127
+    piece = squares[from_sq]
+    on_square = PIECE_CODE_VALUES[piece]
+    gains = [PIECE_CODE_VALUES[squares[to_sq]]]
+    if piece & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1):
+        on_square = PIECE_CODE_VALUES[(move >> 14) or QUEEN]
+        gains[0] += on_square - PIECE_VALUES["p"]
+    lifted = [(from_sq, piece)]
+    squares[from_sq] = EMPTY
+    colour = (piece & BLACK_BIT) ^ BLACK_BIT
+    while True:
+        attacker_sq = _least_valuable_attacker(squares, to_sq, colour)
+        if attacker_sq < 0:
+            break
+        gains.append(on_square - gains[-1])
+        on_square = PIECE_CODE_VALUES[squares[attacker_sq]]
+        lifted.append((attacker_sq, squares[attacker_sq]))
+        squares[attacker_sq] = EMPTY
+        colour ^= BLACK_BIT
+    for sq, lifted_piece in lifted:
+        squares[sq] = lifted_piece
+    # Walk back: each side only recaptures if it does better than stopping
+    while len(gains) > 1:
+        last = gains.pop()
+        gains[-1] = -max(-gains[-1], last)
+    return gains[0]
+
+def _quiescence(position, alpha, beta, ctx, depth):
+    # Extends the search past the horizon with captures and promotions only, so
+    # a position is never scored in the middle of an exchange. Scores are from
+    # White's point of view, like _minimax. depth counts down the remaining
+    # capture plies; at 0 the static evaluation is returned.
+    ctx.nodes += 1
+    ctx.quiescence_nodes += 1
+    if ctx.nodes & 1023 == 0 and (ctx.stop_requested or time.perf_counter() >= ctx.deadline):
+        raise SearchAborted()
+    maximizing = position.white_to_move
+    info = position.check_info()
+    if info is None: # King already captured
+        return -math.inf if maximizing else math.inf
+    in_check = info[1] is not None
+
+    if in_check:
+        # Standing pat isn't an option in check: every evasion is searched
+        if depth == 0:
+            return position.evaluate()
+        moves = list(position.staged_legal_moves())
+        if not moves:
+            return -math.inf if maximizing else math.inf
+        best_eval = -math.inf if maximizing else math.inf
+    else:
+        # Stand pat: the side to move can always decline to capture
+        stand_pat = best_eval = position.evaluate()
+        if depth == 0:
+            return stand_pat
+        if maximizing:
+            if stand_pat >= beta: return stand_pat
+            alpha = max(alpha, stand_pat)
+        else:
+            if stand_pat <= alpha: return stand_pat
+            beta = min(beta, stand_pat)
+        moves = position._ordered_captures(info)
+
+    squares = position.squares
+    for move in moves:
+        if not in_check:
+            # Delta pruning: even winning the victim outright can't reach the window
+            to_sq = (move >> 7) & 127
+            best_case = PIECE_CODE_VALUES[squares[to_sq]] + DELTA_MARGIN
+            if squares[move & 127] & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1):
+                best_case += PIECE_VALUES["q"] - PIECE_VALUES["p"]
+            if (stand_pat + best_case <= alpha) if maximizing else (stand_pat - best_case >= beta):
+                continue
+            if static_exchange(position, move) < 0: # Loses material even after the recaptures
+                continue
+        undo = position.make_move(move)
+        eval_score = _quiescence(position, alpha, beta, ctx, depth - 1)
+        position.unmake_move(undo)
+        if maximizing:
+            if eval_score > best_eval: best_eval = eval_score
+            alpha = max(alpha, eval_score)
+        else:
+            if eval_score < best_eval: best_eval = eval_score
+            beta = min(beta, eval_score)
+        if beta <= alpha: break
+    return best_eval
 
 def minimax(board, depth, alpha, beta, maximizing_player_is_white, current_player_for_moves_str):
+    # Accepts a Position or a list board; the search below only ever makes and
+    # unmakes moves on one Position, it never copies the board.
+    position = as_position(board, current_player_for_moves_str == "White")
+    return _minimax(position, depth, alpha, beta, SearchContext(get_transposition_table()), 0)
+
+def _minimax(position, depth, alpha, beta, ctx, ply):
+    if position.piece_count <= TABLEBASE_MAX_PIECES and USE_TABLEBASES:
+        tablebase = tablebase_score(position, ply)
+        if tablebase is not None:
+            ctx.tablebase_hits += 1
+            return tablebase
+    if depth == 0 and ctx.quiescence_depth:
+        return _quiescence(position, alpha, beta, ctx, ctx.quiescence_depth)
+    ctx.nodes += 1
+    if ctx.nodes & 1023 == 0 and (ctx.stop_requested or time.perf_counter() >= ctx.deadline):
+        raise SearchAborted()
     if depth == 0:
-        return evaluate_board(board)
+        return position.evaluate()
+    tt = ctx.tt
+
+    # Scores are always from White's point of view, so one bound rule serves both sides
+    entry = tt.probe(position.hash)
+    hash_move = 0
+    if entry is not None:
+        entry_depth, entry_score, entry_bound, hash_move = entry
+        if entry_depth >= depth:
+            if entry_bound == TT_EXACT: return entry_score
+            if entry_bound == TT_LOWER: alpha = max(alpha, entry_score)
+            else: beta = min(beta, entry_score)
+            if beta <= alpha: return entry_score
+    alpha_orig, beta_orig = alpha, beta
 
-    player_has_moves = has_any_legal_moves(board, current_player_for_moves_str)
+    # Moves come out already ordered, one stage at a time; a cutoff leaves the rest ungenerated
+    possible_next_moves = position.staged_legal_moves(hash_move, ctx, ply)
     # The king to check for check/checkmate is the one whose turn it is currently in the simulation
-    king_to_check_is_white = (current_player_for_moves_str == "White")
-    king_is_in_check = is_in_check(board, king_to_check_is_white)
+    king_to_check_is_white = position.white_to_move
+    best_move = 0
+
+    if king_to_check_is_white: # Current node is for White (Maximizer)
+        best_eval = -math.inf
+        for move in possible_next_moves:
+            undo = position.make_move(move)
+            # Next node will be Black's turn (Minimizer)
+            eval_score = _minimax(position, depth - 1, alpha, beta, ctx, ply + 1)
+            position.unmake_move(undo)
+            if eval_score > best_eval or best_move == 0:
+                best_eval = eval_score
+                best_move = move
+            alpha = max(alpha, eval_score)
+            if beta <= alpha:
+                ctx.record_cutoff(position, move, depth, ply)
+                break
+    else: # Current node is for Black (Minimizer)
+        best_eval = math.inf
+        for move in possible_next_moves:
+            undo = position.make_move(move)
+            # Next node will be White's turn (Maximizer)
+            eval_score = _minimax(position, depth - 1, alpha, beta, ctx, ply + 1)
+            position.unmake_move(undo)
+            if eval_score < best_eval or best_move == 0:
+                best_eval = eval_score
+                best_move = move
+            beta = min(beta, eval_score)
+            if beta <= alpha:
+                ctx.record_cutoff(position, move, depth, ply)
+                break
 
-    if not player_has_moves:
-        if king_is_in_check: # Checkmate
+    if best_move == 0: # No legal moves (0 never encodes a real move)
+        if position.is_in_check(): # Checkmate
             # If it's White's turn (maximizer) and no moves in check = Black wins (-inf)
             # If it's Black's turn (minimizer) and no moves in check = White wins (+inf)
             return -math.inf if king_to_check_is_white else math.inf 
         else: # Stalemate
             return 0 
 
-    possible_next_moves = get_all_legal_moves_for_player(board, current_player_for_moves_str)
+    if best_eval <= alpha_orig: bound = TT_UPPER
+    elif best_eval >= beta_orig: bound = TT_LOWER
+    else: bound = TT_EXACT
+    tt.store(position.hash, depth, best_eval, bound, best_move)
+    return best_eval
 
-    if maximizing_player_is_white: # Current node is for White (Maximizer)
-        max_eval = -math.inf
-        for start_pos, end_pos in possible_next_moves:
-            temp_board = [r.copy() for r in board]
-            move_piece(temp_board, start_pos, end_pos)
-            # Next node will be Black's turn (Minimizer)
-            eval_score = minimax(temp_board, depth - 1, alpha, beta, False, "Black")
-            max_eval = max(max_eval, eval_score)
+def _search_root(position, depth, alpha, beta, root_moves, ctx):
+    # Searches root_moves in order and returns (best score, best move). The
+    # window narrows as moves are searched, so later moves only need to prove
+    # they are worse than the best so far.
+    maximizing = position.white_to_move
+    best_move = root_moves[0]
+    best_eval = -math.inf if maximizing else math.inf
+    for move in root_moves:
+        undo = position.make_move(move)
+        eval_score = _minimax(position, depth - 1, alpha, beta, ctx, 1)
+        position.unmake_move(undo)
+        if maximizing:
+            if eval_score > best_eval:
+                best_eval = eval_score
+                best_move = move
             alpha = max(alpha, eval_score)
-            if beta <= alpha: break
-        return max_eval
-    else: # Current node is for Black (Minimizer)
-        min_eval = math.inf
-        for start_pos, end_pos in possible_next_moves:
-            temp_board = [r.copy() for r in board]
-            move_piece(temp_board, start_pos, end_pos)
-            # Next node will be White's turn (Maximizer)
-            eval_score = minimax(temp_board, depth - 1, alpha, beta, True, "White")
-            min_eval = min(min_eval, eval_score)
+        else:
+            if eval_score < best_eval:
+                best_eval = eval_score
+                best_move = move
             beta = min(beta, eval_score)
-            if beta <= alpha: break
-        return min_eval
+        if beta <= alpha: break
+    return best_eval, best_move
 
-def get_ai_move(board_state, search_depth, ai_turn_str):
-    best_move = None
-    possible_first_moves = get_all_legal_moves_for_player(board_state, ai_turn_str)
-    random.shuffle(possible_first_moves) 
+def principal_variation(position, max_length, tt=None):
+    # Follows best moves stored in the transposition table from position
+    tt = tt or get_transposition_table()
+    position = position.copy()
+    pv = []
+    seen = set()
+    while len(pv) < max_length and position.hash not in seen:
+        seen.add(position.hash)
+        entry = tt.probe(position.hash)
+        if entry is None or not position.is_legal_move(entry[3]):
+            break
+        pv.append(entry[3])
+        position.make_move(entry[3])
+    return pv
 
+def get_ai_move(board_state, search_depth, ai_turn_str, quiescence_depth=None):
+    # quiescence_depth overrides QUIESCENCE_DEPTH for this search (0 turns it off)
     ai_is_white = (ai_turn_str == "White")
+    position = as_position(board_state, ai_is_white)
+    book_move = opening_book_move(position)
+    if book_move is None:
+        book_move = tablebase_move(position) # Endings covered by the tablebases need no search
+    if book_move is not None:
+        return move_to_coords(book_move)
+    if position is board_state:
+        position = position.copy() # The search mutates in place; leave the caller's board alone
+    ctx = SearchContext(get_transposition_table(), quiescence_depth=quiescence_depth)
+    best_move = _fixed_depth_search(position, search_depth, ctx)[1]
+    return move_to_coords(best_move) if best_move is not None else None
+
+def _fixed_depth_search(position, search_depth, ctx):
+    # get_ai_move's search on a Position: returns (score, move), move None if there are no legal moves
+    possible_first_moves = position.legal_moves()
+    if not possible_first_moves:
+        return 0, None
+    random.shuffle(possible_first_moves) # Tie-breaking between equally ordered moves
+    ctx.tt.new_search()
+    root_entry = ctx.tt.probe(position.hash)
+    order_moves(position, possible_first_moves, root_entry[3] if root_entry else 0)
+    return _search_root(position, search_depth, -math.inf, math.inf, possible_first_moves, ctx)
+
+def _iterative_deepening(position, time_budget_ms, max_depth, ctx, root_moves=None):
+    # Deepens 1, 2, 3... until the budget runs out. Returns (move, score, depth)
+    # from the last completed depth; depth 1 always completes unless cancelled.
+    # root_moves, if given, is this position's legal move list and is reordered in place.
+    start_time = time.perf_counter()
+    budget = time_budget_ms / 1000.0
+    if root_moves is None:
+        root_moves = position.legal_moves()
+    if not root_moves:
+        return None, 0, 0
+    random.shuffle(root_moves)
+    ctx.tt.new_search()
+    root_entry = ctx.tt.probe(position.hash)
+    order_moves(position, root_moves, root_entry[3] if root_entry else 0)
+    best_move, best_score, completed_depth = root_moves[0], 0, 0
+
+    for depth in range(1, max_depth + 1):
+        ctx.deadline = start_time + budget if depth > 1 else math.inf
+        try:
+            if depth > 1 and not math.isinf(best_score):
+                # Aspiration window around the previous score; re-search on failure
+                alpha, beta = best_score - ASPIRATION_WINDOW, best_score + ASPIRATION_WINDOW
+                score, move = _search_root(position, depth, alpha, beta, root_moves, ctx)
+                if score <= alpha or score >= beta:
+                    score, move = _search_root(position, depth, -math.inf, math.inf, root_moves, ctx)
+            else:
+                score, move = _search_root(position, depth, -math.inf, math.inf, root_moves, ctx)
+        except SearchAborted:
+            break
+        best_move, best_score, completed_depth = move, score, depth
+        ctx.iteration_done(depth, score, move)
+        # The previous best move leads the next iteration; the rest of the PV comes from the table
+        root_moves.remove(move)
+        root_moves.insert(0, move)
+        if len(root_moves) == 1 or math.isinf(score):
+            break
+        if time.perf_counter() - start_time >= budget * ID_NEXT_ITERATION_FRACTION:
+            break
+    return best_move, best_score, completed_depth
+
+def iterative_deepening_search(board_state, ai_turn_str, time_budget_ms, max_depth=MAX_SEARCH_DEPTH,
+                               quiescence_depth=None):
+    # Time-managed alternative to get_ai_move: spends up to time_budget_ms searching
+    position = as_position(board_state, ai_turn_str == "White")
+    book_move = opening_book_move(position)
+    if book_move is None:
+        book_move = tablebase_move(position)
+    if book_move is not None:
+        return move_to_coords(book_move)
+    if position is board_state:
+        position = position.copy()
+    ctx = SearchContext(get_transposition_table(), quiescence_depth=quiescence_depth)
+    best_move = _iterative_deepening(position, time_budget_ms, max_depth, ctx)[0]
+    return move_to_coords(best_move) if best_move is not None else None
+
+class SearchHandle:
+    # Runs iterative_deepening_search on a worker thread so the pygame loop keeps
+    # pumping events. Poll done() each frame, then read result(); cancel() stops
+    # the search early and result() is then the best move found so far.
+    def __init__(self, board_state, ai_turn_str, time_budget_ms=None, max_depth=MAX_SEARCH_DEPTH, root_moves=None):
+        # A time_budget_ms of None searches until cancelled (used for pondering).
+        # root_moves lets a caller that already has the legal moves skip generating them again.
+        self.position = as_position(board_state, ai_turn_str == "White").copy()
+        self.time_budget_ms = math.inf if time_budget_ms is None else time_budget_ms
+        self.max_depth = max_depth
+        self.root_moves = None if root_moves is None else list(root_moves)
+        self.ctx = SearchContext(get_transposition_table())
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = _iterative_deepening(self.position, self.time_budget_ms, self.max_depth, self.ctx,
+                                                self.root_moves)
+        except BaseException as error: # Re-raised on the main thread by result()
+            self._error = error
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def cancel(self):
+        # Stops the search and waits for the worker so the table has a single writer again
+        self.ctx.stop_requested = True
+        self._thread.join()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        best_move = self._result[0]
+        return move_to_coords(best_move) if best_move is not None else None
+
+# --- Search Instrumentation ---
+# Counting and timing subclasses of Position and SearchContext. The search only
+# sees them when get_ai_move_with_stats passes them in, so ordinary searches run
+# the plain classes and pay nothing for the instrumentation.
+INSTRUMENTED_CALLS = ("move_generation", "evaluate", "check_detection", "make_unmake")
+
+class InstrumentedPosition(Position):
+    # Times are exclusive: a check test made inside move generation is counted
+    # as a call but its time stays with move generation.
+    __slots__ = ("calls", "seconds", "timing", "ply", "max_ply")
+
+    def __init__(self, squares=None, white_to_move=True):
+        super().__init__(squares, white_to_move)
+        self.calls = dict.fromkeys(INSTRUMENTED_CALLS, 0)
+        self.seconds = dict.fromkeys(INSTRUMENTED_CALLS, 0.0)
+        self.timing = False
+        self.ply = self.max_ply = 0
+
+    def _timed(self, name, method, *args, count=True):
+        if count:
+            self.calls[name] += 1
+        if self.timing:
+            return method(self, *args)
+        self.timing = True
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.timing = False
+
+    def make_move(self, move):
+        self.ply += 1
+        if self.ply > self.max_ply:
+            self.max_ply = self.ply
+        return self._timed("make_unmake", Position.make_move, move)
+
+    def unmake_move(self, undo):
+        self.ply -= 1
+        return self._timed("make_unmake", Position.unmake_move, undo)
+
+    def evaluate(self):
+        return self._timed("evaluate", Position.evaluate)
+
+    def is_in_check(self, king_is_white=None):
+        return self._timed("check_detection", Position.is_in_check, king_is_white)
+
+    def check_info(self):
+        return self._timed("check_detection", Position.check_info)
+
+    def legal_moves(self, from_sq=None):
+        return self._timed("move_generation", Position.legal_moves, from_sq)
+
+    def _ordered_captures(self, info, skip_move=0):
+        return self._timed("move_generation", Position._ordered_captures, info, skip_move)
+
+    def staged_legal_moves(self, hash_move=0, ctx=None, ply=0):
+        # Counted once per generator; each resumption is timed on its own
+        self.calls["move_generation"] += 1
+        stages = Position.staged_legal_moves(self, hash_move, ctx, ply)
+        while True:
+            move = self._timed("move_generation", _next_staged_move, stages, count=False)
+            if move is None:
+                return
+            yield move
+
+def _next_staged_move(position, stages):
+    return next(stages, None)
+
+class InstrumentedSearchContext(SearchContext):
+    __slots__ = ("cutoffs", "iterations", "start_time")
+
+    def __init__(self, tt, deadline=math.inf, quiescence_depth=None):
+        super().__init__(tt, deadline, quiescence_depth)
+        self.cutoffs = 0
+        self.iterations = []
+        self.start_time = time.perf_counter()
+
+    def record_cutoff(self, position, move, depth, ply):
+        self.cutoffs += 1
+        SearchContext.record_cutoff(self, position, move, depth, ply)
+
+    def iteration_done(self, depth, score, move):
+        self.iterations.append({"depth": depth, "score": _json_score(score), "nodes": self.nodes,
+                                "seconds": time.perf_counter() - self.start_time, "move": move})
+
+def _json_score(score):
+    # JSON has no infinity; mates are reported as strings
+    if math.isinf(score):
+        return "+mate" if score > 0 else "-mate"
+    return score
+
+def get_ai_move_with_stats(board_state, ai_turn_str, search_depth=AI_DEPTH, time_budget_ms=None,
+                           quiescence_depth=None, profile=False, log_path=SEARCH_STATS_LOG):
+    # get_ai_move (or iterative_deepening_search when time_budget_ms is given)
+    # plus a report of what the search did. Returns (move coords or None, stats).
+    # profile=True adds the top of a cProfile run to the stats; a file path also
+    # saves the raw profile there for pstats/snakeviz. Timings include the
+    # instrumentation's own overhead, so compare them with each other, not with
+    # uninstrumented runs.
+    position = as_position(board_state, ai_turn_str == "White")
+    search_position = InstrumentedPosition(position.squares, position.white_to_move)
+    tt = get_transposition_table()
+    tt.reset_stats()
+    ctx = InstrumentedSearchContext(tt, quiescence_depth=quiescence_depth)
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if time_budget_ms is None:
+            score, best_move = _fixed_depth_search(search_position, search_depth, ctx)
+            depth_reached = search_depth if best_move is not None else 0
+            if best_move is not None:
+                ctx.iteration_done(search_depth, score, best_move)
+        else:
+            best_move, score, depth_reached = _iterative_deepening(search_position, time_budget_ms,
+                                                                   search_depth, ctx)
+    finally:
+        if profiler:
+            profiler.disable()
+    elapsed = time.perf_counter() - ctx.start_time
+
+    interior_nodes = ctx.nodes - ctx.quiescence_nodes
+    stats = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "fen": position.to_fen(), "side": ai_turn_str,
+        "mode": "time" if time_budget_ms is not None else "depth",
+        "search_depth": search_depth, "time_budget_ms": time_budget_ms, "quiescence_depth": ctx.quiescence_depth,
+        "move": move_to_uci(position, best_move) if best_move is not None else None,
+        "score": _json_score(score), "depth_reached": depth_reached, "max_ply_reached": search_position.max_ply,
+        "seconds": elapsed, "nodes": ctx.nodes, "quiescence_nodes": ctx.quiescence_nodes,
+        "nps": ctx.nodes / elapsed if elapsed else None,
+        "cutoffs": ctx.cutoffs, "cutoff_rate": ctx.cutoffs / interior_nodes if interior_nodes else 0.0,
+        "tablebase_hits": ctx.tablebase_hits,
+        "calls": dict(search_position.calls),
+        "seconds_in": dict(search_position.seconds, other=elapsed - sum(search_position.seconds.values())),
+        "iterations": [dict(iteration, move=move_to_uci(position, iteration["move"]))
+                       for iteration in ctx.iterations],
+        "tt": tt.stats(),
+    }
+    if profiler:
+        import io
+        import pstats
+        if isinstance(profile, str):
+            profiler.dump_stats(profile)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(25)
+        stats["profile"] = report.getvalue()
+    if log_path:
+        import json
+        with open(log_path, "a") as log_file:
+            log_file.write(json.dumps({key: value for key, value in stats.items() if key != "profile"}) + "\n")
+    return (move_to_coords(best_move) if best_move is not None else None), stats
+
+# --- Parallel Search ---
+# Root moves are split across worker processes, which sidesteps the GIL. The
+# first move is searched alone to get a bound, then its siblings run in parallel
+# against the best score finished so far. Each task starts from a cleared table
+# and gets a window fixed by its place in the root order, so a result never
+# depends on which worker finished first.
+_worker_tt = None
+_process_pools = {}
+
+def _init_search_worker(tt_size_mb):
+    global _worker_tt
+    _worker_tt = TranspositionTable(tt_size_mb, current_only=True)
+
+def _score_root_move(tt, squares, white_to_move, move, depth, alpha, beta, quiescence_depth):
+    # Score of one root move and the number of nodes it took, from an emptied
+    # current_only table
+    tt.invalidate()
+    ctx = SearchContext(tt, quiescence_depth=quiescence_depth)
+    position = Position(squares, white_to_move)
+    position.make_move(move)
+    score = _minimax(position, depth - 1, alpha, beta, ctx, 1)
+    return score, ctx.nodes
+
+def _search_root_move(squares, white_to_move, move, depth, alpha, beta, quiescence_depth):
+    # Worker task
+    return _score_root_move(_worker_tt, squares, white_to_move, move, depth, alpha, beta, quiescence_depth)
+
+def get_process_pool(workers):
+    # Pools are kept per worker count; the table budget is split between workers
+    pool = _process_pools.get(workers)
+    if pool is None:
+        from concurrent.futures import ProcessPoolExecutor # Loads multiprocessing, so only when a pool is needed
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_search_worker,
+                                   initargs=(max(1, TT_SIZE_MB // workers),))
+        _process_pools[workers] = pool
+    return pool
+
+def _parallel_search_root(position, depth, root_moves, workers, quiescence_depth=None):
+    # Returns (best score, best move, nodes searched across all workers). Move
+    # i is searched against the best score of moves 0..i-workers (move 0 alone
+    # comes first), so up to `workers` moves are in flight while the bound keeps
+    # tightening, and each window depends only on the root order and worker
+    # count, never on which task finished first. With one worker this is the
+    # plain serial root loop, run in this process.
+    if quiescence_depth is None:
+        quiescence_depth = QUIESCENCE_DEPTH # Resolved here so spawned workers agree with the parent
+    maximizing = position.white_to_move
+    squares = bytes(position.squares)
+    if workers <= 1:
+        if _worker_tt is None:
+            _init_search_worker(TT_SIZE_MB) # This process gets a worker's table, kept for later searches
+        tt = _worker_tt
+    else:
+        pool = get_process_pool(workers)
+    best_score, best_move, nodes = None, None, 0
+    pending = [] # (move, future or result) in root order, not yet folded into the bound
+    for index, move in enumerate(root_moves + [None]):
+        # Fold in finished moves up to index - workers (always move 0) before choosing this move's window
+        while pending and (move is None or index - len(pending) <= max(0, index - workers)):
+            done_move, task = pending.pop(0)
+            score, move_nodes = task if workers <= 1 else task.result()
+            nodes += move_nodes
+            if best_move is None or ((score > best_score) if maximizing else (score < best_score)):
+                best_score, best_move = score, done_move
+        if move is None:
+            break
+        # A move has to beat the best so far to matter: a tie fails low, and the
+        # earlier move in root order keeps the lead, as in the serial root loop
+        if best_move is None: alpha, beta = -math.inf, math.inf
+        elif maximizing: alpha, beta = best_score, math.inf
+        else: alpha, beta = -math.inf, best_score
+        task = (squares, maximizing, move, depth, alpha, beta, quiescence_depth)
+        pending.append((move, _score_root_move(tt, *task) if workers <= 1 else pool.submit(_search_root_move, *task)))
+    return best_score, best_move, nodes
+
+def parallel_get_ai_move(board_state, search_depth, ai_turn_str, workers=AI_WORKERS, seed=None,
+                         quiescence_depth=None):
+    # Multi-core get_ai_move. With a fixed seed the root order, and so the move, is reproducible.
+    position = as_position(board_state, ai_turn_str == "White")
+    rng = random.Random(seed) if seed is not None else random
+    book_move = opening_book_move(position, rng)
+    if book_move is None:
+        book_move = tablebase_move(position)
+    if book_move is not None:
+        return move_to_coords(book_move)
+    root_moves = position.legal_moves()
+    if not root_moves:
+        return None
+    rng.shuffle(root_moves)
+    order_moves(position, root_moves)
+    return move_to_coords(_parallel_search_root(position, search_depth, root_moves, workers, quiescence_depth)[1])
+
+def _benchmark_positions(seed, count=4, plies_between=8):
+    # Start position plus positions reached by seeded random play
+    rng = random.Random(seed)
+    position = Position.from_board(create_board())
+    positions = [position.copy()]
+    while len(positions) < count:
+        for _ in range(plies_between):
+            moves = position.legal_moves()
+            if not moves:
+                position = Position.from_board(create_board())
+                break
+            position.make_move(rng.choice(moves))
+        positions.append(position.copy())
+    return positions
+
+def benchmark_parallel_search(search_depth=3, workers=AI_WORKERS, seed=0):
+    # Wall time for the serial get_ai_move root loop and parallel_get_ai_move to
+    # finish the same depth on the same positions. Node counts are printed too,
+    # since split search does extra work that nodes/sec alone would hide.
+    pool = get_process_pool(workers)
+    list(pool.map(abs, range(workers))) # Start the workers before timing anything
+    serial_tt = TranspositionTable(TT_SIZE_MB)
+    totals = {"serial": [0, 0.0], "parallel": [0, 0.0]}
+    print(f"depth {search_depth}, {workers} workers, seed {seed}")
+    for index, position in enumerate(_benchmark_positions(seed)):
+        root_moves = position.legal_moves()
+        if not root_moves:
+            continue
+        random.Random(seed).shuffle(root_moves)
+
+        serial_tt.clear()
+        ctx = SearchContext(serial_tt)
+        start = time.perf_counter()
+        _search_root(position.copy(), search_depth, -math.inf, math.inf, root_moves, ctx)
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parallel_nodes = _parallel_search_root(position, search_depth, root_moves, workers)[2]
+        parallel_time = time.perf_counter() - start
+
+        for name, nodes, elapsed in (("serial", ctx.nodes, serial_time), ("parallel", parallel_nodes, parallel_time)):
+            totals[name][0] += nodes
+            totals[name][1] += elapsed
+        print(f"position {index}: serial {serial_time:.2f}s ({ctx.nodes} nodes), "
+              f"parallel {parallel_time:.2f}s ({parallel_nodes} nodes), speedup {serial_time / parallel_time:.2f}x")
+    speedup = totals["serial"][1] / totals["parallel"][1]
+    print(f"total: serial {totals['serial'][1]:.2f}s, parallel {totals['parallel'][1]:.2f}s, "
+          f"time-to-depth speedup {speedup:.2f}x, parallel searched "
+          f"{totals['parallel'][0] / totals['serial'][0]:.2f}x the serial nodes")
+    return {"serial_seconds": totals["serial"][1], "parallel_seconds": totals["parallel"][1],
+            "serial_nodes": totals["serial"][0], "parallel_nodes": totals["parallel"][0], "speedup": speedup}
+
+# --- Opening Book ---
+# A book file is a 16-byte header (magic, then the Zobrist key of the start
+# position so a book built with other keys is refused) followed by 12-byte
+# big-endian records: position key, move, weight. Records are sorted by key,
+# so a lookup is a binary search over the memory-mapped file.
+BOOK_MAGIC = b"ACBBOOK1"
+BOOK_HEADER = struct.Struct(">8sQ")
+BOOK_RECORD = struct.Struct(">QHH")
+BOOK_MAX_WEIGHT = 0xFFFF
+SAN_PATTERN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+PGN_RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+
+def _book_move_code(move):
+    # Packed move -> 16 bits: from (0-63) | to << 6 | promotion type << 12
+    from_sq = move & 127
+    to_sq = (move >> 7) & 127
+    return ((from_sq >> 4) * 8 + (from_sq & 7)) | (((to_sq >> 4) * 8 + (to_sq & 7)) << 6) | ((move >> 14) << 12)
+
+def _book_move_from_code(code):
+    from_index, to_index = code & 63, (code >> 6) & 63
+    return encode_move(((from_index >> 3) << 4) | (from_index & 7), ((to_index >> 3) << 4) | (to_index & 7), code >> 12)
+
+def san_to_move(position, san):
+    # Parses standard algebraic notation into a legal packed move, or returns
+    # None. Castling, en passant and under-promotions don't exist in this game,
+    # so they come back as None too.
+    match = SAN_PATTERN.match(san.rstrip("+#!?"))
+    if match is None:
+        return None
+    piece_letter, from_file, from_rank, target, promotion = match.groups()
+    if promotion is not None and promotion != "Q":
+        return None
+    piece_type = PIECE_CODES[piece_letter] if piece_letter else PAWN
+    to_sq = ((ROWS - int(target[1])) << 4) | "abcdefgh".index(target[0])
+    found = None
+    for move in position.legal_moves():
+        from_sq = move & 127
+        if (move >> 7) & 127 != to_sq or position.squares[from_sq] & 7 != piece_type:
+            continue
+        if from_file and "abcdefgh"[from_sq & 7] != from_file:
+            continue
+        if from_rank and str(ROWS - (from_sq >> 4)) != from_rank:
+            continue
+        if found is not None:
+            return None # Ambiguous
+        found = move
+    return found
+
+def read_pgn_games(lines):
+    # Yields (tags, [SAN moves]) per game from an iterable of PGN lines, one game
+    # at a time. Comments, variations, NAGs and move numbers are dropped.
+    tags, movetext = {}, []
+    for line in itertools.chain(lines, ['[Event ""]']): # The sentinel tag flushes the last game
+        line = line.strip()
+        if line.startswith("["):
+            if movetext:
+                text = re.sub(r"\{[^}]*\}|;.*", " ", "\n".join(movetext))
+                while "(" in text:
+                    text = re.sub(r"\([^()]*\)", " ", text)
+                tokens = re.sub(r"\d+\.(\.\.)?|\$\d+", " ", text).split()
+                yield tags, [token for token in tokens if token not in PGN_RESULTS]
+                tags, movetext = {}, []
+            tag = re.match(r'\[(\w+)\s+"(.*)"\]', line)
+            if tag:
+                tags[tag.group(1)] = tag.group(2)
+        elif line:
+            movetext.append(line)
+
+def build_opening_book(pgn_paths, book_path, max_plies=20, min_games=1):
+    # Builds a book from the first max_plies moves of every game in the PGN
+    # files. A move's weight is 2 per win and 1 per draw for the side that
+    # played it (1 per game when the result is unknown), so moves that only
+    # lost never make it in. Moves seen in fewer than min_games games are
+    # dropped. Returns the number of records written.
+    weights, games_seen = {}, {}
+    start_key = Position.from_fen(START_FEN).hash
+    for pgn_path in pgn_paths:
+        with open(pgn_path, encoding="utf-8", errors="replace") as pgn_file:
+            for tags, san_moves in read_pgn_games(pgn_file):
+                if "FEN" in tags:
+                    continue # Not played from the start position
+                result = tags.get("Result", "*")
+                position = Position.from_fen(START_FEN)
+                for san in san_moves[:max_plies]:
+                    move = san_to_move(position, san)
+                    if move is None:
+                        break # Left the rules this game plays by
+                    if result in ("1/2-1/2", "*"): points = 1
+                    elif (result == "1-0") == position.white_to_move: points = 2
+                    else: points = 0
+                    entry = (position.hash, _book_move_code(move))
+                    weights[entry] = weights.get(entry, 0) + points
+                    games_seen[entry] = games_seen.get(entry, 0) + 1
+                    position.make_move(move)
+    records = sorted((key, code, weight) for (key, code), weight in weights.items()
+                     if weight > 0 and games_seen[(key, code)] >= min_games)
+    scale = max((weight for _, _, weight in records), default=0) / BOOK_MAX_WEIGHT
+    with open(book_path, "wb") as book_file:
+        book_file.write(BOOK_HEADER.pack(BOOK_MAGIC, start_key))
+        for key, code, weight in records:
+            if scale > 1:
+                weight = max(1, int(weight / scale))
+            book_file.write(BOOK_RECORD.pack(key, code, weight))
+    return len(records)
+
+class OpeningBook:
+    # Read-only view of a book file. The file is memory-mapped, so opening it
+    # reads nothing up front and lookups only touch the pages they search.
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as book_file:
+            self.data = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, start_key = BOOK_HEADER.unpack_from(self.data, 0)
+        if magic != BOOK_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an opening book file")
+        if start_key != Position.from_fen(START_FEN).hash:
+            self.close()
+            raise ValueError(f"{path} was built with different hash keys; rebuild it")
+        self.count = (len(self.data) - BOOK_HEADER.size) // BOOK_RECORD.size
+
+    def close(self):
+        self.data.close()
+
+    def _key_at(self, index):
+        return struct.unpack_from(">Q", self.data, BOOK_HEADER.size + index * BOOK_RECORD.size)[0]
+
+    def entries(self, key):
+        # [(packed move, weight)] stored for a position key
+        low, high = 0, self.count
+        while low < high: # First record with a key >= key
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        for index in range(low, self.count):
+            record_key, code, weight = BOOK_RECORD.unpack_from(self.data, BOOK_HEADER.size + index * BOOK_RECORD.size)
+            if record_key != key:
+                break
+            found.append((_book_move_from_code(code), weight))
+        return found
+
+    def choose(self, position, rng=random):
+        # Weighted random book move for position, or None once it's out of book
+        moves = [(move, weight) for move, weight in self.entries(position.hash) if position.is_legal_move(move)]
+        if not moves:
+            return None
+        return rng.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+_opening_books = {}
+
+def get_opening_book(path=None):
+    # The book at path (default OPENING_BOOK_PATH), opened once; None if there is no such file
+    path = path or OPENING_BOOK_PATH
+    if path not in _opening_books:
+        _opening_books[path] = OpeningBook(path) if os.path.exists(path) else None
+    return _opening_books[path]
 
-    if ai_is_white: 
-        max_eval_found = -math.inf
-        for start_pos, end_pos in possible_first_moves:
-            temp_board = [r.copy() for r in board_state]
-            move_piece(temp_board, start_pos, end_pos)
-            eval_score = minimax(temp_board, search_depth - 1, -math.inf, math.inf, False, "Black")
-            if eval_score > max_eval_found:
-                max_eval_found = eval_score
-                best_move = (start_pos, end_pos)
-    else: 
-        min_eval_found = math.inf
-        for start_pos, end_pos in possible_first_moves:
-            temp_board = [r.copy() for r in board_state]
-            move_piece(temp_board, start_pos, end_pos)
-            eval_score = minimax(temp_board, search_depth - 1, -math.inf, math.inf, True, "White")
-            if eval_score < min_eval_found:
-                min_eval_found = eval_score
-                best_move = (start_pos, end_pos)
+def opening_book_move(position, rng=random):
+    # Book move for position, or None when the book is off, missing, or has nothing here
+    if not USE_OPENING_BOOK:
+        return None
+    book = get_opening_book()
+    return book.choose(position, rng) if book is not None else None
+
+# --- Endgame Tablebases ---
+# One file per material balance (e.g. "KQvKR.tb", stronger side as White): a
+# 20-byte header, then one byte per position index. 0 means a draw (or an
+# index no position uses); otherwise the byte is the distance to mate in plies
+# plus one, with the side to move winning when that distance is odd. Positions
+# are indexed by square (0-63, row-major like the board), side to move first,
+# then the white king restricted by symmetry: to the a1-d1-d4 triangle for
+# pawnless tables, to files a-d when there are pawns.
+TB_MAGIC = b"ACBTB001"
+TB_HEADER = struct.Struct(">8s8sI") # magic, material key, number of entries
+TB_MAX_PLIES = 254
+TB_PIECE_ORDER = "KQRBNP"
+TABLEBASE_WIN = 1000000 # Search score of a tablebase win, less the plies to mate
+
+def _tb_square_transforms():
+    # The 8 board symmetries as 64-entry square maps: (transpose, flip rows, flip columns)
+    transforms = []
+    for transpose in (False, True):
+        for flip_rows in (False, True):
+            for flip_cols in (False, True):
+                mapping = []
+                for sq in range(64):
+                    row, col = sq >> 3, sq & 7
+                    if transpose: row, col = col, row
+                    if flip_rows: row = 7 - row
+                    if flip_cols: col = 7 - col
+                    mapping.append(row * 8 + col)
+                transforms.append(mapping)
+    return transforms
+
+TB_TRANSFORMS = _tb_square_transforms() # Index 0 is the identity, 1 flips columns only
+TB_TRIANGLE = [sq for sq in range(64) if (sq & 7) <= 3 and (sq >> 3) >= 4 and 7 - (sq >> 3) <= (sq & 7)]
+TB_LEFT_HALF = [sq for sq in range(64) if (sq & 7) <= 3]
+
+class Tablebase:
+    # Layout of one material balance's table, plus its mmap once loaded from disk
+    def __init__(self, key):
+        self.key = key
+        white_letters, black_letters = key.split("v")
+        self.pieces = [PIECE_CODES[letter] for letter in white_letters] + \
+                      [PIECE_CODES[letter.lower()] for letter in black_letters]
+        self.has_pawns = "P" in key
+        region = TB_LEFT_HALF if self.has_pawns else TB_TRIANGLE
+        transforms = TB_TRANSFORMS[:2] if self.has_pawns else TB_TRANSFORMS
+        self.region_squares = region
+        self.region_index = [-1] * 64
+        for index, sq in enumerate(region):
+            self.region_index[sq] = index
+        # For each white king square, the symmetries that bring it into the region
+        self.transforms_for = [[transform for transform in transforms if transform[sq] in region]
+                               for sq in range(64)]
+        # Runs of identical pieces, kept sorted so swapping them doesn't give a new index
+        self.identical_runs = []
+        start = 0
+        for end in range(1, len(self.pieces) + 1):
+            if end == len(self.pieces) or self.pieces[end] != self.pieces[start]:
+                if end - start > 1:
+                    self.identical_runs.append((start, end))
+                start = end
+        self.side_size = len(region) * 64 ** (len(self.pieces) - 1)
+        self.size = 2 * self.side_size
+        self.data = None
+
+    def index(self, squares, white_to_move):
+        # Canonical index of the position with piece i on squares[i] (0-63)
+        best = -1
+        for transform in self.transforms_for[squares[0]]:
+            mapped = [transform[sq] for sq in squares]
+            for start, end in self.identical_runs:
+                mapped[start:end] = sorted(mapped[start:end])
+            index = self.region_index[mapped[0]]
+            for sq in mapped[1:]:
+                index = index * 64 + sq
+            if best < 0 or index < best:
+                best = index
+        return best if white_to_move else best + self.side_size
+
+    def squares_of(self, index):
+        # Inverse of index(): (squares, white_to_move)
+        white_to_move = index < self.side_size
+        index %= self.side_size
+        squares = []
+        for _ in range(len(self.pieces) - 1):
+            squares.append(index & 63)
+            index >>= 6
+        squares.append(self.region_squares[index])
+        squares.reverse()
+        return squares, white_to_move
+
+    def path(self):
+        return os.path.join(TABLEBASE_DIR, self.key + ".tb")
+
+    def load(self):
+        with open(self.path(), "rb") as table_file:
+            self.data = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, key, size = TB_HEADER.unpack_from(self.data, 0)
+        if magic != TB_MAGIC or key.rstrip(b"\0").decode() != self.key or size != self.size:
+            self.data.close()
+            self.data = None
+            raise ValueError(f"{self.path()} is not a valid {self.key} tablebase")
+        return self
+
+def _tb_material_key(white_letters, black_letters):
+    # Key of the table holding this material, and whether colours must be swapped to use it
+    white = "".join(sorted(white_letters, key=TB_PIECE_ORDER.index))
+    black = "".join(sorted(black_letters, key=TB_PIECE_ORDER.index))
+    white_value = sum(PIECE_VALUES[letter.lower()] for letter in white[1:])
+    black_value = sum(PIECE_VALUES[letter.lower()] for letter in black[1:])
+    if (black_value, black) > (white_value, white):
+        return black + "v" + white, True
+    return white + "v" + black, False
+
+_tablebases = {} # Material key -> loaded Tablebase, or None when there's no file
+_tablebase_files = None # Keys with a file in TABLEBASE_DIR, listed on first use
+
+def _reset_tablebases():
+    global _tablebase_files
+    _tablebases.clear()
+    _tablebase_files = None
+
+def available_tablebases():
+    # Material keys with a table file in TABLEBASE_DIR
+    global _tablebase_files
+    if _tablebase_files is None:
+        try:
+            _tablebase_files = {name[:-3] for name in os.listdir(TABLEBASE_DIR) if name.endswith(".tb")}
+        except OSError:
+            _tablebase_files = set()
+    return _tablebase_files
+
+def get_tablebase(key):
+    if key not in _tablebases:
+        _tablebases[key] = Tablebase(key).load() if key in available_tablebases() else None
+    return _tablebases[key]
+
+def tablebase_value(position):
+    # The table byte for position (see the file format above), or None when it
+    # isn't covered. Bare kings are a draw without a table.
+    if position.piece_count > TABLEBASE_MAX_PIECES or min(position.king_squares) < 0:
+        return None
+    if position.piece_count == 2:
+        return 0
+    if not available_tablebases():
+        return None
+    white_letters, black_letters, placed = [], [], []
+    for sq in BOARD_SQUARES:
+        piece = position.squares[sq]
+        if piece != EMPTY:
+            (black_letters if piece & BLACK_BIT else white_letters).append(CODE_TO_PIECE[piece].upper())
+            placed.append((sq, piece))
+    key, swap_colours = _tb_material_key(white_letters, black_letters)
+    table = get_tablebase(key)
+    if table is None:
+        return None
+    white_to_move = position.white_to_move
+    if swap_colours:
+        # Mirror the ranks and swap colours, so the stronger side is White
+        placed = [(((ROWS - 1 - (sq >> 4)) << 4) | (sq & 7), piece ^ BLACK_BIT) for sq, piece in placed]
+        white_to_move = not white_to_move
+    slots = {}
+    for sq, piece in placed:
+        slots.setdefault(piece, []).append((sq >> 4) * 8 + (sq & 7))
+    squares = [slots[piece].pop() for piece in table.pieces]
+    return table.data[TB_HEADER.size + table.index(squares, white_to_move)]
+
+def tablebase_score(position, ply=0):
+    # White-positive search score from the tablebases, or None. Wins score
+    # TABLEBASE_WIN less the plies to mate counted from the root, so the search
+    # prefers the fastest win and the slowest loss.
+    value = tablebase_value(position)
+    if value is None:
+        return None
+    if value == 0:
+        return 0
+    plies = value - 1
+    score = TABLEBASE_WIN - ply - plies
+    side_to_move_wins = plies % 2 == 1
+    return score if side_to_move_wins == position.white_to_move else -score
+
+def tablebase_move(position):
+    # Best move by the tablebases: the fastest mate when winning, the longest
+    # resistance when losing, any drawing move otherwise. None when the
+    # position or one of its children isn't covered.
+    if not USE_TABLEBASES or position.piece_count > TABLEBASE_MAX_PIECES:
+        return None
+    best_move, best_rank = None, None
+    position = position.copy()
+    for move in position.legal_moves():
+        undo = position.make_move(move)
+        value = tablebase_value(position)
+        position.unmake_move(undo)
+        if value is None:
+            return None
+        if value == 0:
+            rank = (1, 0)
+        elif (value - 1) % 2 == 0: # The opponent is to move and gets mated
+            rank = (2, -value)
+        else:
+            rank = (0, value)
+        if best_rank is None or rank > best_rank:
+            best_move, best_rank = move, rank
     return best_move
 
+def _tb_position(table, squares, white_to_move):
+    board = bytearray(128)
+    for piece, sq in zip(table.pieces, squares):
+        board[((sq >> 3) << 4) | (sq & 7)] = piece
+    return Position(board, white_to_move)
+
+def _tb_valid_position(table, squares, position):
+    # Distinct squares, no pawn on a back rank, kings apart, side not to move not in check
+    if len(set(squares)) != len(squares):
+        return False
+    for piece, sq in zip(table.pieces, squares):
+        if piece & 7 == PAWN and (sq >> 3) in (0, ROWS - 1):
+            return False
+    white_king, black_king = position.king_squares
+    if white_king - black_king in KING_OFFSETS:
+        return False
+    return not position.is_in_check(not position.white_to_move)
+
+def _tb_predecessors(table, squares, white_to_move):
+    # Canonical indices of the positions that reach this one with a quiet,
+    # non-promoting move by the side that just moved. Captures and promotions
+    # come from other tables, so they never appear here.
+    mover_colour = BLACK_BIT if white_to_move else 0
+    board = bytearray(128)
+    for piece, sq in zip(table.pieces, squares):
+        board[((sq >> 3) << 4) | (sq & 7)] = piece
+    defender_king = next(((sq >> 3) << 4) | (sq & 7) for piece, sq in zip(table.pieces, squares)
+                         if piece == KING | (mover_colour ^ BLACK_BIT))
+    found = set()
+    for slot, (piece, sq) in enumerate(zip(table.pieces, squares)):
+        if piece & BLACK_BIT != mover_colour:
+            continue
+        to_sq = ((sq >> 3) << 4) | (sq & 7)
+        piece_type = piece & 7
+        origins = []
+        if piece_type == PAWN:
+            backward = -16 if mover_colour else 16
+            from_sq = to_sq + backward
+            if 1 <= (from_sq >> 4) <= ROWS - 2 and board[from_sq] == EMPTY:
+                origins.append(from_sq)
+                start_row = 1 if mover_colour else ROWS - 2
+                if (from_sq + backward) >> 4 == start_row and board[from_sq + backward] == EMPTY:
+                    origins.append(from_sq + backward)
+        elif piece_type == KNIGHT or piece_type == KING:
+            origins = [from_sq for from_sq in (KNIGHT_JUMPS if piece_type == KNIGHT else KING_JUMPS)[to_sq]
+                       if board[from_sq] == EMPTY]
+        else:
+            rays = (ROOK_RAYS[to_sq] if piece_type != BISHOP else ()) + (BISHOP_RAYS[to_sq] if piece_type != ROOK else ())
+            for ray in rays:
+                for from_sq in ray:
+                    if board[from_sq] != EMPTY:
+                        break
+                    origins.append(from_sq)
+        board[to_sq] = EMPTY
+        for from_sq in origins:
+            if piece_type == KING and any(board[near] == KING | (mover_colour ^ BLACK_BIT) for near in KING_JUMPS[from_sq]):
+                continue
+            board[from_sq] = piece
+            # The side that moved mustn't have left the other king in check
+            if not square_attacked(board, defender_king, mover_colour == 0):
+                moved = list(squares)
+                moved[slot] = (from_sq >> 4) * 8 + (from_sq & 7)
+                found.add(table.index(moved, not white_to_move))
+            board[from_sq] = EMPTY
+        board[to_sq] = piece
+    return found
+
+def tablebase_dependencies(key):
+    # Tables that captures and promotions from key's positions lead to
+    white_letters, black_letters = key.split("v")
+    needed = set()
+    for side, letters in ((0, white_letters), (1, black_letters)):
+        for index in range(1, len(letters)):
+            rest = letters[:index] + letters[index + 1:]
+            needed.add((rest, black_letters) if side == 0 else (white_letters, rest))
+            if letters[index] == "P":
+                promoted = letters[:index] + "Q" + letters[index + 1:]
+                needed.add((promoted, black_letters) if side == 0 else (white_letters, promoted))
+    keys = set()
+    for white, black in needed:
+        if len(white) + len(black) > 2:
+            keys.add(_tb_material_key(white, black)[0])
+    return sorted(keys)
+
+def tablebase_keys(max_pieces=TABLEBASE_MAX_PIECES):
+    # Every material key with 3 to max_pieces pieces, smallest tables first
+    keys = set()
+    for extra in range(1, max_pieces - 1):
+        for letters in itertools.combinations_with_replacement("QRBNP", extra):
+            for white_count in range(extra + 1):
+                keys.add(_tb_material_key("K" + "".join(letters[:white_count]),
+                                          "K" + "".join(letters[white_count:]))[0])
+    return sorted(keys, key=lambda key: (len(key), key))
+
+def build_tablebase(key, log=print):
+    # Retrograde analysis of one material balance into TABLEBASE_DIR; tables it
+    # depends on are built first if their files are missing. Returns the
+    # number of won and lost positions (side to move's view; the rest draw).
+    os.makedirs(TABLEBASE_DIR, exist_ok=True)
+    for dependency in tablebase_dependencies(key):
+        if not os.path.exists(Tablebase(dependency).path()):
+            build_tablebase(dependency, log)
+    _reset_tablebases() # Pick up the dependencies just written
+    table = Tablebase(key)
+    started = time.perf_counter()
+    values = bytearray(table.size)
+    resolved = bytearray(table.size) # 1 once the value is final (or the index is unused)
+    counters = array("H", [0]) * table.size # Children not yet known to win for the opponent
+    buckets = {} # Plies to mate -> indices finalised at that distance
+    exit_wins, exit_losses = {}, {} # Plies -> parents with a capture/promotion into a position won/lost at that distance
+
+    # Pass 1: count each position's children and score its captures and promotions
+    for index in range(table.size):
+        squares, white_to_move = table.squares_of(index)
+        if len(set(squares)) != len(squares) or table.index(squares, white_to_move) != index:
+            resolved[index] = 1 # Not a canonical index
+            continue
+        position = _tb_position(table, squares, white_to_move)
+        if not _tb_valid_position(table, squares, position):
+            resolved[index] = 1
+            continue
+        moves = position.legal_moves()
+        if not moves:
+            resolved[index] = 1
+            if position.is_in_check(): # Mated: lost in 0
+                values[index] = 1
+                buckets.setdefault(0, array("I")).append(index)
+            continue
+        children = set()
+        counter = 0
+        for move in moves:
+            from_sq = move & 127
+            to_sq = (move >> 7) & 127
+            moved_piece = position.squares[from_sq]
+            if position.squares[to_sq] != EMPTY or (moved_piece & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1)):
+                undo = position.make_move(move)
+                value = tablebase_value(position)
+                position.unmake_move(undo)
+                counter += 1 # Drawing and winning exits are never decremented
+                if value and (value - 1) % 2 == 1:
+                    exit_wins.setdefault(value - 1, array("I")).append(index)
+                elif value:
+                    exit_losses.setdefault(value - 1, array("I")).append(index)
+                continue
+            from_64 = (from_sq >> 4) * 8 + (from_sq & 7)
+            moved = list(squares)
+            moved[moved.index(from_64)] = (to_sq >> 4) * 8 + (to_sq & 7)
+            children.add(table.index(moved, not white_to_move))
+        counters[index] = counter + len(children)
+    log(f"{key}: {table.size} indices scanned in {time.perf_counter() - started:.1f}s")
+
+    # Pass 2: walk back from the mates one ply at a time. A position is won at
+    # d + 1 as soon as one child is lost at d, and lost at d + 1 once its last
+    # child is won at d; distances come out in increasing order, so the first
+    # win found is the fastest and the last child to fall is the slowest loss.
+    def resolve(index, plies):
+        if plies > TB_MAX_PLIES:
+            raise ValueError(f"{key}: distance to mate over {TB_MAX_PLIES} plies")
+        resolved[index] = 1
+        values[index] = plies + 1
+        buckets.setdefault(plies, array("I")).append(index)
+
+    plies = 0
+    last_plies = max(list(buckets) + list(exit_wins) + list(exit_losses), default=-1)
+    while plies <= last_plies:
+        for index in exit_losses.pop(plies, ()):
+            if not resolved[index]: resolve(index, plies + 1)
+        for index in exit_wins.pop(plies, ()):
+            if not resolved[index]:
+                counters[index] -= 1
+                if counters[index] == 0: resolve(index, plies + 1)
+        for child in buckets.get(plies, ()):
+            squares, white_to_move = table.squares_of(child)
+            for index in _tb_predecessors(table, squares, white_to_move):
+                if resolved[index]:
+                    continue
+                if plies % 2 == 0: # Child lost for its side to move: the parent wins
+                    resolve(index, plies + 1)
+                else:
+                    counters[index] -= 1
+                    if counters[index] == 0: resolve(index, plies + 1)
+        if plies + 1 in buckets:
+            last_plies = max(last_plies, plies + 1)
+        plies += 1
+
+    path = table.path()
+    with open(path + ".tmp", "wb") as table_file:
+        table_file.write(TB_HEADER.pack(TB_MAGIC, key.encode(), table.size))
+        table_file.write(values)
+    os.replace(path + ".tmp", path)
+    _reset_tablebases()
+    wins = losses = 0
+    for value in values:
+        if value:
+            if (value - 1) % 2: wins += 1
+            else: losses += 1
+    log(f"{key}: {wins} won, {losses} lost, longest mate {max(buckets, default=0)} plies, "
+        f"{time.perf_counter() - started:.1f}s, written to {path}")
+    return wins, losses
+
+# --- Batch Evaluation ---
+# NumPy versions of Position.evaluate() and square_attacked() for scoring many
+# positions at once. Positions are packed as an (N, 64) int8 array of piece
+# codes in list board order (index row * 8 + col). NumPy is only imported when
+# one of these is called, so the rest of the program doesn't need it.
+BATCH_CHUNK = 1 << 16 # Rows processed per step, which bounds the temporary arrays
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("batch evaluation needs NumPy (pip install numpy)") from None
+    return numpy
+
+def pack_positions(positions):
+    # Positions, list boards or FEN strings -> (N, 64) int8 piece codes
+    np = _numpy()
+    raw = bytearray()
+    for position in positions:
+        if isinstance(position, str):
+            position = Position.from_fen(position)
+        if isinstance(position, Position):
+            for row_start in range(0, ROWS << 4, 16):
+                raw += position.squares[row_start:row_start + COLS]
+        else:
+            raw += bytes(PIECE_CODES[piece] for row in position for piece in row)
+    return np.frombuffer(raw, dtype=np.int8).reshape(-1, ROWS * COLS)
+
+def _by_chunks(np, packed, function):
+    packed = np.asarray(packed, dtype=np.int8).reshape(-1, ROWS * COLS)
+    if len(packed) <= BATCH_CHUNK:
+        return function(np, packed)
+    return np.concatenate([function(np, packed[start:start + BATCH_CHUNK])
+                           for start in range(0, len(packed), BATCH_CHUNK)])
+
+def _evaluate_chunk(np, packed):
+    # The evaluation tables can be switched at runtime, so read them per call
+    squares = np.arange(ROWS * COLS)
+    codes = packed.astype(np.intp)
+    mg = np.array(EVAL_MG, dtype=np.int32)[:, BOARD_SQUARES][codes, squares].sum(axis=1, dtype=np.int64)
+    eg = np.array(EVAL_EG, dtype=np.int32)[:, BOARD_SQUARES][codes, squares].sum(axis=1, dtype=np.int64)
+    phase = np.minimum(np.array(PHASE_OF_CODE, dtype=np.int64)[codes].sum(axis=1), MAX_PHASE)
+    return (mg * phase + eg * (MAX_PHASE - phase)) // MAX_PHASE
+
+def batch_evaluate(packed):
+    # Same scores as evaluate_board for every row, as an int64 array
+    return _by_chunks(_numpy(), packed, _evaluate_chunk)
+
+def _shifted(np, planes, offset):
+    # planes moved by a 0x88 square offset, with anything leaving the board dropped
+    d_row = (offset + 8) // 16
+    d_col = offset - d_row * 16
+    moved = np.zeros_like(planes)
+    moved[:, max(d_row, 0):ROWS + min(d_row, 0), max(d_col, 0):COLS + min(d_col, 0)] = \
+        planes[:, max(-d_row, 0):ROWS + min(-d_row, 0), max(-d_col, 0):COLS + min(-d_col, 0)]
+    return moved
+
+def _attack_chunk(np, packed):
+    boards = packed.reshape(-1, ROWS, COLS)
+    empty = boards == EMPTY
+    masks = np.zeros((len(boards), 2, ROWS, COLS), dtype=bool)
+    for colour_index, colour in enumerate((0, BLACK_BIT)):
+        attacked = masks[:, colour_index]
+        pawns = boards == (PAWN | colour)
+        for offset in ((15, 17) if colour else (-15, -17)):
+            attacked |= _shifted(np, pawns, offset)
+        for piece_type, offsets in ((KNIGHT, KNIGHT_OFFSETS), (KING, KING_OFFSETS)):
+            pieces = boards == (piece_type | colour)
+            for offset in offsets:
+                attacked |= _shifted(np, pieces, offset)
+        queens = boards == (QUEEN | colour)
+        for piece_type, directions in ((ROOK, ROOK_DIRECTIONS), (BISHOP, BISHOP_DIRECTIONS)):
+            sliders = (boards == (piece_type | colour)) | queens
+            for direction in directions:
+                ray = _shifted(np, sliders, direction)
+                while ray.any():
+                    attacked |= ray # Includes the first occupied square, like square_attacked
+                    ray = _shifted(np, ray & empty, direction)
+    return masks.reshape(-1, 2, ROWS * COLS)
+
+def batch_attack_masks(packed):
+    # (N, 2, 64) bools: [:, 0] squares White attacks, [:, 1] squares Black
+    # attacks, matching square_attacked for every square of every row
+    return _by_chunks(_numpy(), packed, _attack_chunk)
+
+def evaluate_moves(position, moves):
+    # Scores of the positions after each move, evaluated as one batch
+    np = _numpy()
+    moves = list(moves)
+    packed = np.repeat(pack_positions([position]), len(moves), axis=0)
+    for row, move in enumerate(moves):
+        from_sq = move & 127
+        to_sq = (move >> 7) & 127
+        piece = position.squares[from_sq]
+        if piece & 7 == PAWN and (to_sq >> 4) in (0, ROWS - 1):
+            piece = (piece & BLACK_BIT) | ((move >> 14) or QUEEN)
+        packed[row, (from_sq >> 4) * COLS + (from_sq & 7)] = EMPTY
+        packed[row, (to_sq >> 4) * COLS + (to_sq & 7)] = piece
+    return batch_evaluate(packed)
+
+def game_positions(games):
+    # FENs of every position in tournament JSON-lines records (as written by
+    # run_tournament), replayed from the start position
+    import json
+    for line in games:
+        if not line.strip():
+            continue
+        position = Position.from_fen(START_FEN)
+        yield position.to_fen()
+        for san in json.loads(line)["san"]:
+            move = san_to_move(position, san)
+            if move is None:
+                break
+            position.make_move(move)
+            yield position.to_fen()
+
+# --- Benchmarks ---
+# Perft counts follow this game's rules: no castling or en passant, and pawns
+# always promote to queens. They were produced by the original list-board move
+# generator; the start position matches the standard published numbers.
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w - - 0 1"
+PERFT_SUITE = [
+    ("startpos", START_FEN, [20, 400, 8902, 197281]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w - - 0 1", [46, 1865, 86585]),
+    ("rook-endgame", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2810, 43087, 671300]),
+    ("promotions", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w - - 0 1", [6, 222, 7855, 305965]),
+    ("discovered-checks", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w - - 1 8", [40, 1339, 51750]),
+    ("italian-middlegame", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890]),
+]
+SEARCH_BENCH_POSITIONS = [(name, fen) for name, fen, _ in PERFT_SUITE]
+
+def perft(position, depth):
+    # Number of leaf nodes of the legal move tree, depth plies deep
+    moves = position.legal_moves()
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        undo = position.make_move(move)
+        nodes += perft(position, depth - 1)
+        position.unmake_move(undo)
+    return nodes
+
+def _measure(run, trace_memory, setup=None):
+    # Times run() and, in a second traced pass, records its peak Python allocation
+    if setup: setup()
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    peak_bytes = None
+    if trace_memory:
+        import tracemalloc
+        if setup: setup()
+        tracemalloc.start()
+        run()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak_bytes
+
+def run_benchmarks(perft_depth=3, search_depth=3, trace_memory=True, label=None, quiescence_depth=None):
+    # Headless perft + fixed-depth search benchmark; returns a JSON-ready dict
+    import platform
+    report = {
+        "label": label, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "perft": [], "search": [], "perft_ok": True,
+        "quiescence_depth": QUIESCENCE_DEPTH if quiescence_depth is None else quiescence_depth,
+    }
+    for name, fen, expected_counts in PERFT_SUITE:
+        for depth in range(1, min(perft_depth, len(expected_counts)) + 1):
+            position = Position.from_fen(fen)
+            nodes, elapsed, peak_bytes = _measure(lambda: perft(position, depth), trace_memory)
+            ok = nodes == expected_counts[depth - 1]
+            report["perft_ok"] = report["perft_ok"] and ok
+            report["perft"].append({
+                "position": name, "depth": depth, "nodes": nodes, "expected": expected_counts[depth - 1],
+                "ok": ok, "seconds": elapsed, "nps": nodes / elapsed if elapsed else None,
+                "peak_bytes": peak_bytes,
+            })
+    tt = get_transposition_table()
+    for name, fen in SEARCH_BENCH_POSITIONS:
+        for depth in range(1, search_depth + 1):
+            ctx = SearchContext(tt, quiescence_depth=quiescence_depth)
+            def reset_search():
+                tt.clear()
+                ctx.nodes = ctx.quiescence_nodes = 0
+                random.seed(0) # Same root shuffle every run
+            def run_search():
+                return _fixed_depth_search(Position.from_fen(fen), depth, ctx)
+            (score, move), elapsed, peak_bytes = _measure(run_search, trace_memory, reset_search)
+            report["search"].append({
+                "position": name, "depth": depth, "nodes": ctx.nodes,
+                "quiescence_nodes": ctx.quiescence_nodes, "seconds": elapsed,
+                "nps": ctx.nodes / elapsed if elapsed else None, "score": score,
+                "move": move_to_coords(move) if move is not None else None, "peak_bytes": peak_bytes,
+            })
+    total_nodes = sum(entry["nodes"] for entry in report["search"])
+    total_seconds = sum(entry["seconds"] for entry in report["search"])
+    report["search_total"] = {"nodes": total_nodes, "seconds": total_seconds,
+                              "nps": total_nodes / total_seconds if total_seconds else None}
+    try:
+        import resource
+        report["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError: # Not available on Windows
+        report["peak_rss_kb"] = None
+    return report
+
+# --- Headless Tournaments ---
+MAX_GAME_PLIES = 400 # Tournament games still running after this many plies are drawn
+
+def insufficient_material(position):
+    # Bare kings, or kings plus a single bishop or knight
+    minor_pieces = 0
+    for sq in BOARD_SQUARES:
+        piece_type = position.squares[sq] & 7
+        if piece_type in (PAWN, ROOK, QUEEN):
+            return False
+        if piece_type in (KNIGHT, BISHOP):
+            minor_pieces += 1
+    return minor_pieces <= 1
+
+def engine_name(engine):
+    # engine is a dict with "depth" and/or "time_ms" (time-managed when "time_ms" is set,
+    # with "depth" then an optional cap), plus an optional "quiescence" depth that
+    # overrides QUIESCENCE_DEPTH. A missing or None depth means the default.
+    if engine.get("time_ms"):
+        name = f"time={engine['time_ms']}ms"
+        if engine.get("depth"):
+            name += f" maxdepth={engine['depth']}"
+    else:
+        name = f"depth={engine.get('depth') or AI_DEPTH}"
+    if engine.get("quiescence") is not None:
+        name += f" qs={engine['quiescence']}"
+    return name
+
+def _engine_move(engine, position, tt):
+    # Returns (packed move, nodes searched) so games can report each side's search effort
+    ctx = SearchContext(tt, quiescence_depth=engine.get("quiescence"))
+    if engine.get("time_ms"):
+        move = _iterative_deepening(position.copy(), engine["time_ms"], engine.get("depth") or MAX_SEARCH_DEPTH,
+                                    ctx)[0]
+    else:
+        move = _fixed_depth_search(position.copy(), engine.get("depth") or AI_DEPTH, ctx)[1]
+    return move, ctx.nodes
+
+def play_headless_game(white_engine, black_engine, opening_plies=0, seed=None, max_plies=MAX_GAME_PLIES):
+    # Plays one AI-vs-AI game without a window. The first opening_plies moves are
+    # random (from seed) so repeated games differ. Returns a JSON-ready record.
+    rng = random.Random(seed)
+    random.seed(seed) # get_ai_move's tie-breaking shuffle
+    # One table per side, new each game: engines with different settings mustn't
+    # read each other's entries, and earlier games mustn't change this one
+    tables = {"White": TranspositionTable(TT_SIZE_MB), "Black": TranspositionTable(TT_SIZE_MB)}
+    position = Position.from_board(create_board())
+    repetitions = {position.hash: 1}
+    halfmove_clock = 0
+    san_moves, uci_moves = [], []
+    nodes = {"White": 0, "Black": 0}
+    while True:
+        turn = position.turn_str()
+        if not has_any_legal_moves(position, turn):
+            if is_in_check(position, position.white_to_move):
+                result, termination = ("0-1" if position.white_to_move else "1-0"), "checkmate"
+            else:
+                result, termination = "1/2-1/2", "stalemate"
+            break
+        if repetitions[position.hash] >= 3:
+            result, termination = "1/2-1/2", "threefold repetition"
+            break
+        if halfmove_clock >= 100:
+            result, termination = "1/2-1/2", "fifty-move rule"
+            break
+        if insufficient_material(position):
+            result, termination = "1/2-1/2", "insufficient material"
+            break
+        if len(uci_moves) >= max_plies:
+            result, termination = "1/2-1/2", "move limit"
+            break
+
+        if len(uci_moves) < opening_plies:
+            move = rng.choice(position.legal_moves())
+        else:
+            move, move_nodes = _engine_move(white_engine if position.white_to_move else black_engine, position,
+                                            tables[turn])
+            nodes[turn] += move_nodes
+        san_moves.append(move_to_san(position, move))
+        uci_moves.append(move_to_uci(position, move))
+        moved_piece = position.squares[move & 127]
+        captured = position.squares[(move >> 7) & 127]
+        position.make_move(move)
+        halfmove_clock = 0 if (moved_piece & 7 == PAWN or captured != EMPTY) else halfmove_clock + 1
+        repetitions[position.hash] = repetitions.get(position.hash, 0) + 1
+
+    return {"white": engine_name(white_engine), "black": engine_name(black_engine), "result": result,
+            "termination": termination, "plies": len(uci_moves), "seed": seed,
+            "opening_plies": opening_plies, "white_nodes": nodes["White"], "black_nodes": nodes["Black"],
+            "san": san_moves, "uci": uci_moves, "final_fen": position.to_fen()}
+
+def game_to_pgn(game, round_number=1, event="AI Chess Battle tournament"):
+    headers = [("Event", event), ("Site", "?"), ("Date", time.strftime("%Y.%m.%d")), ("Round", str(round_number)),
+               ("White", game["white"]), ("Black", game["black"]), ("Result", game["result"]),
+               ("Termination", game["termination"]), ("PlyCount", str(game["plies"]))]
+    lines = [f'[{name} "{value}"]' for name, value in headers]
+    movetext, line = [], ""
+    for index, san in enumerate(game["san"]):
+        token = (f"{index // 2 + 1}. " if index % 2 == 0 else "") + san
+        if len(line) + len(token) + 1 > 79:
+            movetext.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    token = game["result"]
+    movetext.append(f"{line} {token}" if line else token)
+    return "\n".join(lines) + "\n\n" + "\n".join(movetext) + "\n\n"
+
+def elo_difference(wins, draws, losses):
+    # Elo difference implied by the score, with a 95% confidence margin
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0, math.inf
+    score = (wins + draws / 2) / games
+    def to_elo(fraction):
+        if fraction <= 0: return -math.inf
+        if fraction >= 1: return math.inf
+        return -400 * math.log10(1 / fraction - 1) + 0.0 # + 0.0 turns -0.0 into 0.0
+    if score in (0, 1):
+        return to_elo(score), math.inf
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    margin = 1.96 * math.sqrt(variance / games)
+    return to_elo(score), (to_elo(score + margin) - to_elo(score - margin)) / 2
+
+def _play_tournament_game(game_index, engine_a, engine_b, opening_plies, seed, max_plies):
+    # Process pool task: engine A has White in even games, Black in odd ones
+    a_is_white = game_index % 2 == 0
+    white_engine, black_engine = (engine_a, engine_b) if a_is_white else (engine_b, engine_a)
+    # Each pair of games shares an opening, so both engines play both sides of it
+    game = play_headless_game(white_engine, black_engine, opening_plies, seed * 1000003 + game_index // 2, max_plies)
+    game["game"] = game_index
+    game["a_is_white"] = a_is_white
+    return game
+
+def run_tournament(engine_a, engine_b, games, workers=AI_WORKERS, seed=0, opening_plies=4,
+                   max_plies=MAX_GAME_PLIES, pgn_path=None, jsonl_path=None):
+    # Plays games across a process pool, appending each game to the PGN/JSONL files
+    # as soon as it finishes; only the running totals are kept in memory.
+    totals = {"wins": 0, "draws": 0, "losses": 0} # From engine A's point of view
+    engine_nodes = {"a": 0, "b": 0}
+    pgn_file = open(pgn_path, "a") if pgn_path else None
+    jsonl_file = open(jsonl_path, "a") if jsonl_path else None
+    import json
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            next_game, pending = 0, set()
+            while next_game < games or pending:
+                while next_game < games and len(pending) < workers * 2:
+                    pending.add(pool.submit(_play_tournament_game, next_game, engine_a, engine_b,
+                                            opening_plies, seed, max_plies))
+                    next_game += 1
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    game = future.result()
+                    if game["result"] == "1/2-1/2":
+                        totals["draws"] += 1
+                    elif (game["result"] == "1-0") == game["a_is_white"]:
+                        totals["wins"] += 1
+                    else:
+                        totals["losses"] += 1
+                    a_colour, b_colour = ("white", "black") if game["a_is_white"] else ("black", "white")
+                    engine_nodes["a"] += game[a_colour + "_nodes"]
+                    engine_nodes["b"] += game[b_colour + "_nodes"]
+                    if pgn_file:
+                        pgn_file.write(game_to_pgn(game, game["game"] + 1))
+                        pgn_file.flush()
+                    if jsonl_file:
+                        jsonl_file.write(json.dumps(game) + "\n")
+                        jsonl_file.flush()
+                    played = sum(totals.values())
+                    print(f"game {game['game'] + 1}: {game['white']} vs {game['black']} {game['result']} "
+                          f"({game['termination']}, {game['plies']} plies) "
+                          f"[A +{totals['wins']} ={totals['draws']} -{totals['losses']} of {played}]", flush=True)
+    finally:
+        for stream in (pgn_file, jsonl_file):
+            if stream: stream.close()
+
+    elo, margin = elo_difference(totals["wins"], totals["draws"], totals["losses"])
+    played = sum(totals.values())
+    summary = dict(totals, games=played, engine_a=engine_name(engine_a), engine_b=engine_name(engine_b),
+                   score=(totals["wins"] + totals["draws"] / 2) / played if played else None,
+                   elo_difference=elo, elo_margin_95=margin,
+                   engine_a_nodes=engine_nodes["a"], engine_b_nodes=engine_nodes["b"])
+    print(f"{summary['engine_a']} vs {summary['engine_b']}: +{totals['wins']} ={totals['draws']} -{totals['losses']}, "
+          f"Elo difference {elo:+.1f} +/- {margin:.1f}, nodes searched A {engine_nodes['a']} / B {engine_nodes['b']}")
+    return summary
+
+# --- UCI Protocol ---
+# Plain-text protocol spoken by chess GUIs and tournament managers over
+# stdin/stdout. The search runs on a thread so "stop" and "isready" are
+# answered while it thinks.
+UCI_ENGINE_NAME = "AI Chess Battle"
+UCI_MOVES_TO_GO = 30 # Moves the remaining clock time is shared over when the GUI doesn't say
+UCI_MOVE_OVERHEAD_MS = 50 # Kept in hand for process and pipe latency
+
+def uci_to_move(position, text):
+    # Legal packed move for coordinate notation such as "e2e4", or None
+    for move in position.legal_moves():
+        if move_to_uci(position, move) == text:
+            return move
+    return None
+
+def _uci_score(position, score, pv_length):
+    # Score from the side to move's view: centipawns, or moves to mate
+    if not position.white_to_move:
+        score = -score
+    if math.isinf(score) or abs(score) > TABLEBASE_WIN // 2:
+        plies = pv_length if math.isinf(score) else TABLEBASE_WIN - abs(score)
+        mate_moves = (plies + 1) // 2
+        return f"mate {mate_moves if score > 0 else -mate_moves}"
+    return f"cp {score * 100 // PIECE_VALUES['p']}"
+
+class UciSearchContext(SearchContext):
+    # Reports every completed depth as a UCI "info" line
+    __slots__ = ("position", "send", "start_time")
+
+    def __init__(self, tt, position, send):
+        super().__init__(tt)
+        self.position = position
+        self.send = send
+        self.start_time = time.perf_counter()
+
+    def iteration_done(self, depth, score, move):
+        elapsed = time.perf_counter() - self.start_time
+        line = self.position.copy()
+        line.make_move(move)
+        pv = [move] + principal_variation(line, depth - 1, self.tt)
+        line = self.position.copy()
+        pv_text = []
+        for pv_move in pv:
+            pv_text.append(move_to_uci(line, pv_move))
+            line.make_move(pv_move)
+        self.send(f"info depth {depth} score {_uci_score(self.position, score, len(pv))} nodes {self.nodes} "
+                  f"nps {int(self.nodes / elapsed) if elapsed > 0 else 0} time {int(elapsed * 1000)} "
+                  f"pv {' '.join(pv_text)}")
+
+class UciEngine:
+    # One UCI session: the position set by the GUI, the engine's own
+    # transposition table and the search in progress, if any
+    def __init__(self, output=None):
+        self.output = output or sys.stdout
+        self.output_lock = threading.Lock()
+        self.hash_mb = TT_SIZE_MB
+        self.own_book = USE_OPENING_BOOK
+        self.tt = None # Allocated on "isready" or the first "go", after any Hash option
+        self.position = Position.from_fen(START_FEN)
+        self.search_thread = None
+        self.search_ctx = None
+        self.stop_event = threading.Event()
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def table(self):
+        if self.tt is None:
+            self.tt = TranspositionTable(self.hash_mb)
+        return self.tt
+
+    def handle(self, line):
+        # Runs one command line; returns False on "quit"
+        words = line.split()
+        if not words:
+            return True
+        command, words = words[0], words[1:]
+        if command == "uci":
+            self.send(f"id name {UCI_ENGINE_NAME}")
+            self.send("id author AI Chess Battle contributors")
+            self.send(f"option name Hash type spin default {TT_SIZE_MB} min 1 max 4096")
+            self.send(f"option name OwnBook type check default {'true' if USE_OPENING_BOOK else 'false'}")
+            self.send("uciok")
+        elif command == "isready":
+            self.table()
+            self.send("readyok")
+        elif command == "setoption":
+            self.set_option(words)
+        elif command == "ucinewgame":
+            self.stop()
+            if self.tt is not None:
+                self.tt.clear()
+        elif command == "position":
+            self.stop()
+            self.set_position(words)
+        elif command == "go":
+            self.stop()
+            self.go(words)
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            return False
+        elif command not in ("debug", "ponderhit", "register"):
+            self.send(f"info string unknown command {command}")
+        return True
+
+    def set_option(self, words):
+        # setoption name <name> [value <value>]
+        if "value" in words:
+            name = " ".join(words[1:words.index("value")]).lower()
+            value = " ".join(words[words.index("value") + 1:])
+        else:
+            name, value = " ".join(words[1:]).lower(), ""
+        if name == "hash":
+            self.hash_mb = max(1, int(value))
+            self.tt = None
+        elif name == "ownbook":
+            self.own_book = value.lower() == "true"
+        else:
+            self.send(f"info string unknown option {name}")
+
+    def set_position(self, words):
+        # position (startpos | fen <fen>) [moves <move> ...]
+        moves_at = words.index("moves") if "moves" in words else len(words)
+        if words[:1] == ["fen"]:
+            position = Position.from_fen(" ".join(words[1:moves_at]))
+        else:
+            position = Position.from_fen(START_FEN)
+        for text in words[moves_at + 1:]:
+            move = uci_to_move(position, text)
+            if move is None:
+                self.send(f"info string illegal move {text}")
+                break
+            position.make_move(move)
+        self.position = position
+
+    def go(self, words):
+        # go [depth N] [movetime MS] [wtime MS btime MS winc MS binc MS movestogo N] [infinite]
+        limits = {}
+        for name, value in zip(words, words[1:]):
+            if name in ("depth", "movetime", "wtime", "btime", "winc", "binc", "movestogo"):
+                limits[name] = int(value)
+        max_depth = limits.get("depth", MAX_SEARCH_DEPTH)
+        clock, increment = ("wtime", "winc") if self.position.white_to_move else ("btime", "binc")
+        if "movetime" in limits:
+            time_budget_ms = limits["movetime"]
+        elif clock in limits and "infinite" not in words:
+            time_left = limits[clock]
+            time_budget_ms = time_left / limits.get("movestogo", UCI_MOVES_TO_GO) + limits.get(increment, 0) * 3 / 4
+            time_budget_ms = max(1, min(time_budget_ms, time_left - UCI_MOVE_OVERHEAD_MS))
+        else:
+            time_budget_ms = math.inf # Until "stop", or until the depth limit
+        self.stop_event.clear()
+        self.search_ctx = UciSearchContext(self.table(), self.position.copy(), self.send)
+        self.search_thread = threading.Thread(target=self._search, daemon=True,
+                                              args=(time_budget_ms, max_depth, "infinite" in words))
+        self.search_thread.start()
+
+    def _search(self, time_budget_ms, max_depth, infinite):
+        position = self.search_ctx.position.copy()
+        move = opening_book_move(position) if self.own_book else None
+        if move is None:
+            move = tablebase_move(position)
+        if move is None:
+            move = _iterative_deepening(position, time_budget_ms, max_depth, self.search_ctx)[0]
+        if infinite:
+            self.stop_event.wait() # "go infinite" only answers after "stop"
+        self.send(f"bestmove {move_to_uci(position, move) if move is not None else '0000'}")
+
+    def stop(self):
+        # Ends the search in progress, if any, once its bestmove has been sent
+        if self.search_thread is None:
+            return
+        self.search_ctx.stop_requested = True
+        self.stop_event.set()
+        self.search_thread.join()
+        self.search_thread = None
+
+def run_uci(input_stream=None, output=None):
+    # Reads UCI commands until "quit" or end of input
+    engine = UciEngine(output)
+    for line in input_stream or sys.stdin:
+        if not engine.handle(line):
+            return
+    engine.stop()
+
 def main():
+    try:
+        _pygame()
+    except ImportError:
+        sys.exit("The game window needs pygame: pip install pygame")
     pygame.init()
     win = pygame.display.set_mode((WIDTH, HEIGHT))
     
-    main_board = create_board()
+    game = GameState() # Board, side to move and cached legal moves/check status
     selected_piece_coords = None 
-    current_player_turn = "White"
     valid_moves_for_display = [] 
     
     is_check_active = False
@@ -364,25 +3081,27 @@ def main():
     game_is_over = False
     
     ai_is_thinking = False # Flag to indicate AI is in its thinking period
-    ai_thinking_start_time = 0 # Timestamp when AI started thinking
+    ai_search = None # SearchHandle for the AI's move, polled once per frame
+    ponder_search = None # SearchHandle pondering on the human's time
+    ponder_enabled = AI_PONDER and (PLAYER_WHITE_IS_AI != PLAYER_BLACK_IS_AI)
 
     running = True
     clock = pygame.time.Clock()
-    pygame.display.set_caption(f"Chess - {current_player_turn}'s Turn")
+    pygame.display.set_caption(f"Chess - {game.current_player_turn}'s Turn")
 
     while running:
-        current_time_ticks = pygame.time.get_ticks()
-
+        current_player_turn = game.current_player_turn
+        human_moved = False # A click made a move this frame, so the game-over status above is stale
         # --- Determine if current player is AI ---
         is_current_player_ai = (current_player_turn == "White" and PLAYER_WHITE_IS_AI) or \
                                (current_player_turn == "Black" and PLAYER_BLACK_IS_AI)
 
         # --- Game State Updates (Check, Checkmate, Stalemate) ---
+        # Cached per position, so frames where nothing moved cost nothing here
         if not game_is_over:
-            current_player_king_is_white = (current_player_turn == "White")
-            is_check_active = is_in_check(main_board, current_player_king_is_white)
+            is_check_active = game.is_check()
             
-            if not has_any_legal_moves(main_board, current_player_turn):
+            if game.is_game_over():
                 if is_check_active:
                     is_checkmate_active = True
                     # The player whose turn it IS, is checkmated. The OTHER player wins.
@@ -397,6 +3116,9 @@ def main():
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED, pygame.WINDOWRESTORED) \
+               and _board_renderer is not None:
+                _board_renderer.target = None # The window may have lost its contents: repaint all of it next frame
             
             # Human player input (only if not AI's turn and game not over)
             if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and \
@@ -407,20 +3129,25 @@ def main():
 
                 if clicked_row is None: continue
 
-                clicked_square_content = main_board[clicked_row][clicked_col]
+                clicked_square_content = game.board[clicked_row][clicked_col]
 
                 if selected_piece_coords: 
                     if (clicked_row, clicked_col) in valid_moves_for_display:
-                        move_piece(main_board, selected_piece_coords, (clicked_row, clicked_col))
-                        current_player_turn = "Black" if current_player_turn == "White" else "White"
+                        if ponder_search:
+                            ponder_search.cancel(); ponder_search = None
+                        game.make_move(selected_piece_coords, (clicked_row, clicked_col))
+                        current_player_turn = game.current_player_turn
                         selected_piece_coords = None
                         valid_moves_for_display = []
+                        human_moved = True
+                        is_current_player_ai = (current_player_turn == "White" and PLAYER_WHITE_IS_AI) or \
+                                               (current_player_turn == "Black" and PLAYER_BLACK_IS_AI)
                     elif clicked_square_content != ".":
                         is_clk_pc_white = clicked_square_content.isupper()
                         is_curr_plyr_white = (current_player_turn == "White")
                         if is_clk_pc_white == is_curr_plyr_white:
                             selected_piece_coords = (clicked_row, clicked_col)
-                            valid_moves_for_display = get_valid_moves(main_board, selected_piece_coords, current_player_turn)
+                            valid_moves_for_display = game.valid_moves_from(selected_piece_coords)
                         else:
                             selected_piece_coords = None; valid_moves_for_display = []
                     else:
@@ -430,7 +3157,7 @@ def main():
                     is_curr_plyr_white = (current_player_turn == "White")
                     if is_clk_pc_white == is_curr_plyr_white:
                         selected_piece_coords = (clicked_row, clicked_col)
-                        valid_moves_for_display = get_valid_moves(main_board, selected_piece_coords, current_player_turn)
+                        valid_moves_for_display = game.valid_moves_from(selected_piece_coords)
             
             if game_is_over and event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_q: # Allow quitting with 'Q' after game over
@@ -438,35 +3165,53 @@ def main():
 
 
         # --- AI's Turn Logic ---
-        if not game_is_over and is_current_player_ai:
+        if not running or game_is_over:
+            for search in (ai_search, ponder_search):
+                if search: search.cancel()
+            ai_search = ponder_search = None
+        elif human_moved:
+            pass # The next frame re-reads whose turn it is and whether the game is over
+        elif is_current_player_ai:
+            ai_move_ready = False
+            if ponder_search: # Only one search may write the transposition table at a time
+                ponder_search.cancel(); ponder_search = None
             if not ai_is_thinking: # AI starts its "thinking" phase
-                ai_is_thinking = True
-                ai_thinking_start_time = current_time_ticks
-                # Caption and board will be updated below before flip to show "thinking"
-            
-            # Check if thinking duration has passed
-            if ai_is_thinking and (current_time_ticks - ai_thinking_start_time >= AI_THINKING_DURATION):
-                # AI's thinking time is over, now make the move
-                ai_best_move = get_ai_move(main_board, AI_DEPTH, current_player_turn)
-                
+                # Book and tablebase moves are played at once, without a search
+                ai_best_move = game.book_move() or game.tablebase_move()
+                if ai_best_move:
+                    ai_move_ready = True
+                else:
+                    ai_is_thinking = True
+                    # The search runs on a worker thread; this loop keeps drawing and handling events
+                    ai_search = SearchHandle(game.position, current_player_turn, AI_THINKING_DURATION,
+                                             root_moves=game.legal_moves())
+            elif ai_search.done():
+                ai_best_move = ai_search.result()
+                ai_search = None
+                ai_move_ready = True
+
+            if ai_move_ready:
                 if ai_best_move:
                     start_pos, end_pos = ai_best_move
-                    move_piece(main_board, start_pos, end_pos)
+                    game.make_move(start_pos, end_pos)
                 else:
                     # This case should be covered by checkmate/stalemate detection
                     print(f"AI ({current_player_turn}) found no move (should be game over).")
                 
-                current_player_turn = "Black" if current_player_turn == "White" else "White"
+                current_player_turn = game.current_player_turn
                 ai_is_thinking = False # Reset thinking flag for the next AI turn
                 selected_piece_coords = None # Clear any human selection visual
                 valid_moves_for_display = []
+        elif ponder_enabled and ponder_search is None:
+            # Human to move: search their position until they move, filling the
+            # transposition table with the replies the AI will need next
+            ponder_search = SearchHandle(game.position, current_player_turn, root_moves=game.legal_moves())
         
         # --- Drawing ---
-        win.fill(BLACK_SQUARE_COLOR) 
         # Pass current_player_turn for the thinking message color
-        draw_board(win, main_board, selected_piece_coords, valid_moves_for_display, 
-                   is_check_active, is_checkmate_active, is_stalemate_active, 
-                   ai_is_thinking, current_player_turn if ai_is_thinking else None) 
+        dirty_rects = draw_board(win, game.board, selected_piece_coords, valid_moves_for_display, 
+                                 is_check_active, is_checkmate_active, is_stalemate_active, 
+                                 ai_is_thinking, current_player_turn if ai_is_thinking else None) 
         
         # --- Update Window Caption ---
         if game_is_over:
@@ -482,11 +3227,131 @@ def main():
         else:
              pygame.display.set_caption(f"Chess - {current_player_turn}'s Turn {'(Check!)' if is_check_active else ''}")
 
-        pygame.display.flip()
+        pygame.display.update(dirty_rects) # Only the squares that changed this frame
         clock.tick(30)
 
     pygame.quit()
     sys.exit()
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support() # Worker processes in the PyInstaller build
+
+    parser = argparse.ArgumentParser(description="Pygame AI vs AI chess. Runs the game window when no command is given.")
+    commands = parser.add_subparsers(dest="command")
+    bench_parallel_parser = commands.add_parser("bench-parallel", help="compare serial and multi-core search speed")
+    bench_parallel_parser.add_argument("--depth", type=int, default=3)
+    bench_parallel_parser.add_argument("--workers", type=int, default=AI_WORKERS)
+    bench_parallel_parser.add_argument("--seed", type=int, default=0)
+    bench_parser = commands.add_parser("bench", help="headless perft and search benchmark, printed as JSON")
+    bench_parser.add_argument("--perft-depth", type=int, default=3)
+    bench_parser.add_argument("--search-depth", type=int, default=3)
+    bench_parser.add_argument("--no-memory", action="store_true", help="skip the traced peak-memory pass")
+    bench_parser.add_argument("--label", help="version label stored in the report")
+    bench_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    bench_parser.add_argument("--quiescence", type=int, default=None,
+                              help=f"quiescence depth cap, 0 = off (default {QUIESCENCE_DEPTH})")
+    tournament_parser = commands.add_parser("tournament", help="headless AI-vs-AI games between two engine settings")
+    tournament_parser.add_argument("--games", type=int, default=100)
+    tournament_parser.add_argument("--workers", type=int, default=AI_WORKERS)
+    for side in ("a", "b"):
+        tournament_parser.add_argument(f"--{side}-depth", type=int, default=None,
+                                       help=f"engine {side.upper()} search depth (default {AI_DEPTH}); "
+                                            f"with --{side}-time-ms, an optional depth cap")
+        tournament_parser.add_argument(f"--{side}-time-ms", type=int, default=0,
+                                       help=f"engine {side.upper()} time per move; 0 = fixed depth")
+        tournament_parser.add_argument(f"--{side}-quiescence", type=int, default=None,
+                                       help=f"engine {side.upper()} quiescence depth cap, 0 = off "
+                                            f"(default {QUIESCENCE_DEPTH})")
+    tournament_parser.add_argument("--seed", type=int, default=0, help="opening randomization seed")
+    tournament_parser.add_argument("--opening-plies", type=int, default=4, help="random plies at the start of each game")
+    tournament_parser.add_argument("--max-plies", type=int, default=MAX_GAME_PLIES)
+    tournament_parser.add_argument("--pgn", help="append finished games to this PGN file")
+    tournament_parser.add_argument("--jsonl", help="append finished games to this JSON-lines file")
+    analyse_parser = commands.add_parser("analyse", help="search one position and print what the search did as JSON")
+    analyse_parser.add_argument("--fen", default=START_FEN)
+    analyse_parser.add_argument("--depth", type=int, default=None,
+                                help=f"fixed search depth (default {AI_DEPTH}), or the depth cap with --time-ms")
+    analyse_parser.add_argument("--time-ms", type=int, default=None, help="search by time instead of fixed depth")
+    analyse_parser.add_argument("--quiescence", type=int, default=None,
+                                help=f"quiescence depth cap, 0 = off (default {QUIESCENCE_DEPTH})")
+    analyse_parser.add_argument("--profile", nargs="?", const=True, default=False, metavar="PROF_FILE",
+                                help="include a cProfile summary; with a file name, also save the raw profile")
+    analyse_parser.add_argument("--log", default=SEARCH_STATS_LOG, help="append the stats to this JSON-lines file")
+    book_parser = commands.add_parser("build-book", help="build an opening book file from PGN games")
+    book_parser.add_argument("pgn", nargs="+", help="PGN files to read")
+    book_parser.add_argument("--output", default=OPENING_BOOK_PATH)
+    book_parser.add_argument("--max-plies", type=int, default=20, help="book depth in plies")
+    book_parser.add_argument("--min-games", type=int, default=1, help="drop moves seen in fewer games")
+    tablebase_parser = commands.add_parser("build-tablebases", help="generate endgame tablebase files")
+    tablebase_parser.add_argument("keys", nargs="*", help="material keys such as KQvKR (default: all tables "
+                                                         "up to --pieces pieces)")
+    tablebase_parser.add_argument("--pieces", type=int, default=3, help="largest table to build, kings included")
+    tablebase_parser.add_argument("--dir", default=TABLEBASE_DIR, help="output directory")
+    commands.add_parser("uci", help="run as a UCI engine on stdin/stdout, for chess GUIs and tournament managers")
+    evaluate_parser = commands.add_parser("evaluate", help="score many positions at once with NumPy, as JSON lines")
+    evaluate_parser.add_argument("fen_files", nargs="*", help="files with one FEN per line (- for stdin)")
+    evaluate_parser.add_argument("--games", nargs="+", default=[],
+                                 help="tournament JSON-lines files; every position of every game is scored")
+    args = parser.parse_args()
+
+    if args.command == "bench-parallel":
+        benchmark_parallel_search(args.depth, args.workers, args.seed)
+    elif args.command == "bench":
+        import json
+        bench_report = run_benchmarks(args.perft_depth, args.search_depth, not args.no_memory, args.label,
+                                      args.quiescence)
+        if args.output:
+            with open(args.output, "w") as report_file:
+                json.dump(bench_report, report_file, indent=2)
+        else:
+            print(json.dumps(bench_report, indent=2))
+        sys.exit(0 if bench_report["perft_ok"] else 1)
+    elif args.command == "analyse":
+        import json
+        analyse_position = Position.from_fen(args.fen)
+        analyse_depth = args.depth or (AI_DEPTH if args.time_ms is None else MAX_SEARCH_DEPTH)
+        _, search_stats = get_ai_move_with_stats(analyse_position, analyse_position.turn_str(), analyse_depth,
+                                                 args.time_ms, args.quiescence, args.profile, args.log)
+        profile_text = search_stats.pop("profile", None)
+        print(json.dumps(search_stats, indent=2))
+        if profile_text:
+            print(profile_text)
+    elif args.command == "build-book":
+        record_count = build_opening_book(args.pgn, args.output, args.max_plies, args.min_games)
+        print(f"wrote {record_count} book moves to {args.output}")
+    elif args.command == "build-tablebases":
+        TABLEBASE_DIR = args.dir
+        for tablebase_key in args.keys or tablebase_keys(min(args.pieces, TABLEBASE_MAX_PIECES)):
+            tablebase_key = _tb_material_key(*tablebase_key.upper().split("V"))[0]
+            if os.path.exists(Tablebase(tablebase_key).path()):
+                print(f"{tablebase_key}: already built")
+            else:
+                build_tablebase(tablebase_key)
+    elif args.command == "uci":
+        run_uci()
+    elif args.command == "evaluate":
+        import json
+        def read_lines(path):
+            if path == "-":
+                yield from sys.stdin
+                return
+            with open(path) as input_file:
+                yield from input_file
+        fens = itertools.chain((line.strip() for path in args.fen_files for line in read_lines(path) if line.strip()),
+                               (fen for path in args.games for fen in game_positions(read_lines(path))))
+        while True:
+            fen_batch = list(itertools.islice(fens, BATCH_CHUNK))
+            if not fen_batch:
+                break
+            for fen, score in zip(fen_batch, batch_evaluate(pack_positions(fen_batch)).tolist()):
+                print(json.dumps({"fen": fen, "score": score}))
+    elif args.command == "tournament":
+        run_tournament({"depth": args.a_depth, "time_ms": args.a_time_ms, "quiescence": args.a_quiescence},
+                       {"depth": args.b_depth, "time_ms": args.b_time_ms, "quiescence": args.b_quiescence},
+                       args.games, args.workers, args.seed, args.opening_plies, args.max_plies,
+                       args.pgn, args.jsonl)
+    else:
+        main()